@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Answer cache keyed on (notebook, file set, corpus version) plus the query embedding.
+    A lookup returns a stored answer when the cosine similarity of the query embeddings is above
+    the threshold. Entries expire after `ttl_seconds` and the least recently used are evicted
+    beyond `max_entries`.
+    """
+
+    def __init__(self, similarity_threshold: float = 0.95, ttl_seconds: int = 86400, max_entries: int = 2048):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self._entries: "OrderedDict[int, Tuple[Hashable, np.ndarray, str, float]]" = OrderedDict()
+        self._buckets: Dict[Hashable, List[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(notebook_id: str, sources: Optional[List[str]], version: int) -> Tuple:
+        return (notebook_id, tuple(sorted(sources)) if sources is not None else None, version)
+
+    @staticmethod
+    def _normalize(embedding: Any) -> np.ndarray:
+        vector = np.asarray(embedding, dtype="float32")
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, key: Hashable, embedding: Any) -> Optional[str]:
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            entry_ids = self._buckets.get(key, [])
+            for entry_id in [i for i in entry_ids if self._entries[i][3] + self.ttl_seconds <= now]:
+                self._remove(entry_id)
+            entry_ids = self._buckets.get(key, [])
+            if entry_ids:
+                matrix = np.stack([self._entries[i][1] for i in entry_ids])
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    entry_id = entry_ids[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return self._entries[entry_id][2]
+            self.misses += 1
+            return None
+
+    def store(self, key: Hashable, embedding: Any, answer: str):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (key, self._normalize(embedding), answer, time.time())
+            self._buckets.setdefault(key, []).append(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, notebook_id: str):
+        """Drop every answer of a notebook, e.g. after its corpus version changed."""
+        with self._lock:
+            for key in [key for key in self._buckets if key[0] == notebook_id]:
+                for entry_id in list(self._buckets[key]):
+                    self._remove(entry_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, entry_id: int):
+        key = self._entries.pop(entry_id)[0]
+        bucket = self._buckets[key]
+        bucket.remove(entry_id)
+        if not bucket:
+            del self._buckets[key]
@@ -0,0 +1,233 @@
+import uuid
+from collections import Counter
+from typing import Any, Collection, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from langchain.schema import Document
+
+from ai.text_analyzer import Analyzer, default_analyzer
+
+
+def _term_matrix(columns: List[Dict[int, int]], n_terms: int) -> sparse.csr_matrix:
+    """Term-major CSR matrix (row = term id, column = document, value = term frequency)."""
+    term_ids, doc_ids, tfs = [], [], []
+    for col, frequencies in enumerate(columns):
+        term_ids.extend(frequencies.keys())
+        tfs.extend(frequencies.values())
+        doc_ids.extend([col] * len(frequencies))
+    return sparse.csr_matrix(
+        (np.asarray(tfs, dtype=np.float32), (np.asarray(term_ids, dtype=np.int64), np.asarray(doc_ids, dtype=np.int64))),
+        shape=(n_terms, len(columns)),
+    )
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a term-major CSR matrix.
+    Documents live in two segments: a large merged one and a small one holding recent additions,
+    which is rebuilt on each add and merged into the large one once it exceeds `merge_ratio` of it.
+    Removals only clear a document's live flag until the next merge drops it; the merged segment
+    keeps a document-major list of term ids, so a removal only touches the removed documents' terms.
+    A query reads the posting rows of its terms from both segments and scores them with NumPy, so
+    the cost depends on the postings of the query terms, not on the number of documents.
+    Each document is analyzed once; its term frequencies are kept for merges.
+    """
+
+    def __init__(
+        self,
+        k1: float = 1.5,
+        b: float = 0.75,
+        analyzer: Optional[Analyzer] = None,
+        merge_ratio: float = 0.1,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.analyzer = analyzer or default_analyzer
+        self.merge_ratio = merge_ratio
+
+        self.vocab: Dict[str, int] = {}
+        self.total_length = 0
+        # Per row (document slot): doc id, length (0 once removed) and live flag
+        self._doc_ids: List[Any] = []
+        self._rows: Dict[Any, int] = {}
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._live = np.zeros(0, dtype=bool)
+        self._df = np.zeros(0, dtype=np.int64)  # live documents per term id
+        # Rows [0, _base_rows) are in _base, the rest in _recent (whose term frequencies are kept in _recent_tfs)
+        self._base = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self._base_rows = 0
+        # Document-major term ids of _base: the terms of row r are _base_terms[_base_term_ptr[r]:_base_term_ptr[r + 1]]
+        self._base_term_ptr = np.zeros(1, dtype=np.int32)
+        self._base_terms = np.zeros(0, dtype=np.int32)
+        self._recent = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self._recent_tfs: List[Dict[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @property
+    def avgdl(self) -> float:
+        return self.total_length / len(self._rows) if self._rows else 0.0
+
+    def copy(self) -> "BM25Index":
+        """
+        Copy-on-write clone, used to build the next index snapshot while readers search this one.
+        The merged segment's arrays are shared (they are never modified in place); per-row and
+        per-term arrays are copied.
+        """
+        clone = BM25Index(self.k1, self.b, self.analyzer, self.merge_ratio)
+        clone.vocab = dict(self.vocab)
+        clone.total_length = self.total_length
+        clone._doc_ids = list(self._doc_ids)
+        clone._rows = dict(self._rows)
+        clone._lengths = self._lengths.copy()
+        clone._live = self._live.copy()
+        clone._df = self._df.copy()
+        clone._base = self._base
+        clone._base_rows = self._base_rows
+        clone._base_term_ptr = self._base_term_ptr
+        clone._base_terms = self._base_terms
+        clone._recent = self._recent
+        clone._recent_tfs = list(self._recent_tfs)
+        return clone
+
+    def add_documents(self, documents: List[Document], ids: Optional[List[Any]] = None) -> List[Any]:
+        return self.add_texts([doc.page_content for doc in documents], ids)
+
+    def add_texts(self, texts: Iterable[str], ids: Optional[List[Any]] = None) -> List[Any]:
+        texts = list(texts)
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+        if len(ids) != len(texts):
+            raise ValueError("Got uneven list of texts and ids.")
+        self.remove_documents([doc_id for doc_id in ids if doc_id in self._rows])
+
+        lengths = []
+        for doc_id, text in zip(ids, texts):
+            tokens = self.analyzer(text)
+            frequencies = {}
+            for term, tf in Counter(tokens).items():
+                term_id = self.vocab.get(term)
+                if term_id is None:
+                    term_id = self.vocab[term] = len(self.vocab)
+                frequencies[term_id] = tf
+            self._rows[doc_id] = len(self._doc_ids)
+            self._doc_ids.append(doc_id)
+            self._recent_tfs.append(frequencies)
+            lengths.append(len(tokens))
+            self.total_length += len(tokens)
+
+        self._lengths = np.concatenate([self._lengths, np.asarray(lengths, dtype=np.float32)])
+        self._live = np.concatenate([self._live, np.ones(len(texts), dtype=bool)])
+        if len(self._df) < len(self.vocab):
+            self._df = np.concatenate([self._df, np.zeros(len(self.vocab) - len(self._df), dtype=np.int64)])
+        new_term_ids = [term_id for frequencies in self._recent_tfs[-len(texts):] for term_id in frequencies] if texts else []
+        np.add.at(self._df, np.asarray(new_term_ids, dtype=np.int64), 1)
+
+        if len(self._recent_tfs) > self.merge_ratio * self._base_rows:
+            self._merge()
+        else:
+            self._recent = _term_matrix(self._recent_tfs, len(self.vocab))
+        return ids
+
+    def remove_documents(self, ids: Iterable[Any]):
+        removed = 0
+        for doc_id in ids:
+            row = self._rows.pop(doc_id, None)
+            if row is None:
+                continue
+            self._live[row] = False
+            self.total_length -= int(self._lengths[row])
+            self._lengths[row] = 0
+            if row < self._base_rows:
+                term_ids = self._base_terms[self._base_term_ptr[row]:self._base_term_ptr[row + 1]]
+            else:
+                term_ids = np.fromiter(self._recent_tfs[row - self._base_rows].keys(), dtype=np.int64)
+            self._df[term_ids] -= 1
+            removed += 1
+
+        if removed and len(self._doc_ids) - len(self._rows) > self.merge_ratio * max(self._base_rows, 1):
+            self._merge()
+
+    def _merge(self):
+        """Fold the recent segment into the merged one and drop removed documents."""
+        n_terms = len(self.vocab)
+        base = self._base
+        if base.shape[0] < n_terms:
+            base = sparse.vstack([base, sparse.csr_matrix((n_terms - base.shape[0], base.shape[1]), dtype=np.float32)])
+        matrix = sparse.hstack([base, _term_matrix(self._recent_tfs, n_terms)], format="csc")
+        live_rows = np.flatnonzero(self._live)
+        by_doc = matrix[:, live_rows]
+        matrix = by_doc.tocsr()
+        matrix.sort_indices()
+
+        self._base = matrix
+        self._base_rows = len(live_rows)
+        self._base_term_ptr = by_doc.indptr
+        self._base_terms = by_doc.indices
+        self._doc_ids = [self._doc_ids[row] for row in live_rows]
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._doc_ids)}
+        self._lengths = self._lengths[live_rows]
+        self._live = np.ones(len(live_rows), dtype=bool)
+        self._recent = sparse.csr_matrix((n_terms, 0), dtype=np.float32)
+        self._recent_tfs = []
+
+    def idf(self, term_ids: np.ndarray) -> np.ndarray:
+        # Non-negative BM25 idf, so no corpus-wide pass is needed to floor negative values
+        df = self._df[term_ids]
+        n = len(self._rows)
+        return np.log1p((n - df + 0.5) / (df + 0.5))
+
+    def get_scores(self, query: str, allowed_ids: Optional[Collection[Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (rows, scores) of the live documents that contain at least one query term, restricted to
+        `allowed_ids` when given. Repeated query terms count once per occurrence.
+        """
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if not self._rows:
+            return empty
+        query_terms = Counter(self.analyzer.analyze_query(query))
+        term_ids = np.asarray([self.vocab[t] for t in query_terms if t in self.vocab], dtype=np.int64)
+        if not len(term_ids):
+            return empty
+        weights = self.idf(term_ids) * np.asarray([query_terms[t] for t in query_terms if t in self.vocab])
+
+        k1, b, avgdl = self.k1, self.b, self.avgdl
+        row_parts, score_parts = [], []
+        for matrix, offset in ((self._base, 0), (self._recent, self._base_rows)):
+            indptr = matrix.indptr
+            for term_id, weight in zip(term_ids, weights):
+                if term_id >= matrix.shape[0]:
+                    continue
+                start, end = indptr[term_id], indptr[term_id + 1]
+                if start == end:
+                    continue
+                rows = matrix.indices[start:end] + offset
+                tf = matrix.data[start:end]
+                norm = k1 * (1 - b + b * self._lengths[rows] / avgdl)
+                row_parts.append(rows)
+                score_parts.append(weight * tf * (k1 + 1) / (tf + norm))
+        if not row_parts:
+            return empty
+
+        rows = np.concatenate(row_parts)
+        scores = np.bincount(rows, weights=np.concatenate(score_parts), minlength=len(self._doc_ids))
+        mask = self._live.copy()
+        if allowed_ids is not None:
+            allowed = np.zeros(len(self._doc_ids), dtype=bool)
+            allowed[[self._rows[doc_id] for doc_id in allowed_ids if doc_id in self._rows]] = True
+            mask &= allowed
+        mask &= scores > 0
+        hit_rows = np.flatnonzero(mask)
+        return hit_rows, scores[hit_rows]
+
+    def search(self, query: str, k: int, allowed_ids: Optional[Collection[Any]] = None) -> List[Tuple[Any, float]]:
+        """Return the top-k (doc_id, score) pairs."""
+        rows, scores = self.get_scores(query, allowed_ids)
+        if len(rows) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return [(self._doc_ids[rows[i]], float(scores[i])) for i in order]
+
@@ -0,0 +1,58 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from langchain.schema import Document
+
+
+def build_context(docs: List[Document]) -> str:
+    """Concatenate pages with their citation headers. Same pages in the same order give the same bytes."""
+    return "".join(f"{context_header(doc)}{doc.page_content}\n\n" for doc in docs)
+
+
+def context_header(doc: Document) -> str:
+    """Citation header `build_context` puts before a page."""
+    source = os.path.basename(doc.metadata.get("source", "unknown"))
+    page = doc.metadata.get("page", "unknown")
+    return f"--- Source: {source}, Page: {page} ---\n"
+
+
+class ContextCache:
+    """
+    LRU cache of assembled full-context strings keyed by (notebook, file set, corpus version).
+    Entries of a notebook are dropped when its corpus changes.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(notebook_id: str, sources: Optional[List[str]], version: int) -> Tuple:
+        return (notebook_id, tuple(sorted(sources)) if sources is not None else None, version)
+
+    def get_or_build(self, key: Hashable, build: Callable[[], str]) -> str:
+        with self._lock:
+            context = self._entries.get(key)
+            if context is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return context
+            self.misses += 1
+
+        context = build()
+        with self._lock:
+            self._entries[key] = context
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return context
+
+    def invalidate(self, notebook_id: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == notebook_id]:
+                del self._entries[key]
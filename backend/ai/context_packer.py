@@ -0,0 +1,166 @@
+import re
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain.schema import Document
+
+from ai.context_cache import build_context, context_header
+from ai.token_counter import count_tokens
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+_rng = np.random.RandomState(7)
+_NUM_PERM = 64
+# Fixed permutations, so signatures (and therefore the packed context) are the same in every process
+_PERM_A = _rng.randint(1, (1 << 31) - 1, size=_NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, (1 << 31) - 1, size=_NUM_PERM).astype(np.uint64)
+
+
+def minhash_signature(text: str, shingle_size: int = 5) -> np.ndarray:
+    """MinHash of the word shingles of `text`. The share of equal slots estimates Jaccard similarity."""
+    words = _WORD.findall(text.lower())
+    if len(words) <= shingle_size:
+        shingles = {" ".join(words)}
+    else:
+        shingles = {" ".join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ((hashes[:, None] * _PERM_A + _PERM_B) % _MERSENNE_PRIME).min(axis=0)
+
+
+def strip_boilerplate(docs: List[Document], min_pages: int = 3, min_share: float = 0.5) -> List[Document]:
+    """
+    Remove lines repeated on at least `min_share` of a source's pages (running headers, footers,
+    copyright notices), when the source has at least `min_pages` pages in `docs`.
+    """
+    pages_per_source = Counter(doc.metadata.get("source") for doc in docs)
+    line_pages = Counter()
+    for doc in docs:
+        source = doc.metadata.get("source")
+        if pages_per_source[source] >= min_pages:
+            for line in {line.strip() for line in doc.page_content.splitlines() if line.strip()}:
+                line_pages[(source, line)] += 1
+
+    repeated = {
+        key for key, pages in line_pages.items()
+        if pages >= min_pages and pages >= min_share * pages_per_source[key[0]]
+    }
+    if not repeated:
+        return docs
+
+    stripped = []
+    for doc in docs:
+        source = doc.metadata.get("source")
+        lines = [line for line in doc.page_content.splitlines() if (source, line.strip()) not in repeated]
+        stripped.append(Document(page_content="\n".join(lines), metadata=doc.metadata))
+    return stripped
+
+
+@dataclass
+class PackedContext:
+    text: str
+    documents: List[Document]
+    tokens: int
+    duplicates: int = 0
+    over_budget: int = 0
+
+
+class ContextPacker:
+    """
+    Assembles prompt context within a token budget.
+    Boilerplate lines are stripped, near-duplicate passages (MinHash Jaccard >= `dedup_threshold`)
+    are dropped, and with `diversify=True` passages are picked greedily by MMR: relevance from the
+    retrieval rank, redundancy from the shingle similarity to passages already picked. Each passage
+    keeps its [Source, Page] header, so citations survive packing.
+    """
+
+    def __init__(
+        self,
+        budget_tokens: int,
+        dedup_threshold: float = 0.8,
+        mmr_lambda: float = 0.7,
+        boilerplate_min_pages: int = 3,
+    ):
+        self.budget_tokens = budget_tokens
+        self.dedup_threshold = dedup_threshold
+        self.mmr_lambda = mmr_lambda
+        self.boilerplate_min_pages = boilerplate_min_pages
+
+    def pack(
+        self,
+        docs: List[Document],
+        diversify: bool = False,
+        budget_tokens: Optional[int] = None,
+        page_tokens: Optional[List[Optional[int]]] = None,
+    ) -> PackedContext:
+        """
+        `docs` in relevance order (or reading order for full context). With `diversify=False` the
+        kept passages stay in input order; otherwise they are in MMR pick order.
+        `page_tokens` are the cached token counts of the pages (see DocumentStore.page_tokens), parallel
+        to `docs`; pages without one (None) are counted here. Counts of pages that lose boilerplate
+        lines are kept as they are, so the budget errs on the safe side.
+        """
+        budget = self.budget_tokens if budget_tokens is None else budget_tokens
+        if page_tokens is None:
+            page_tokens = [None] * len(docs)
+        pages = [
+            (doc, count) for doc, count in zip(strip_boilerplate(docs, self.boilerplate_min_pages), page_tokens)
+            if doc.page_content.strip()
+        ]
+        if not pages:
+            return PackedContext(text="", documents=[], tokens=0)
+        docs = [doc for doc, _ in pages]
+
+        signatures = np.stack([minhash_signature(doc.page_content) for doc in docs])
+        # The citation header costs about the same on every page of a source, so it is counted once per
+        # source; the extra token covers longer page numbers and the blank line after the page
+        header_tokens: Dict[str, int] = {}
+        tokens = []
+        for doc, count in pages:
+            source = doc.metadata.get("source", "unknown")
+            if source not in header_tokens:
+                header_tokens[source] = count_tokens(context_header(doc)) + 1
+            tokens.append(header_tokens[source] + (count if count is not None else count_tokens(doc.page_content)))
+        relevance = 1.0 - np.arange(len(docs)) / len(docs)
+
+        # Highest similarity of each passage to the passages picked so far
+        redundancy = np.zeros(len(docs))
+        remaining = np.ones(len(docs), dtype=bool)
+        picked: List[int] = []
+        used = 0
+        duplicates = 0
+        over_budget = 0
+
+        while remaining.any():
+            if diversify:
+                scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+                scores[~remaining] = -np.inf
+                i = int(np.argmax(scores))
+            else:
+                i = int(np.argmax(remaining))
+            remaining[i] = False
+
+            if redundancy[i] >= self.dedup_threshold:
+                duplicates += 1
+                continue
+            # The first passage is always kept, so a single oversized page still gets an answer
+            if picked and used + tokens[i] > budget:
+                over_budget += 1
+                continue
+
+            picked.append(i)
+            used += tokens[i]
+            similarity = (signatures == signatures[i]).mean(axis=1)
+            redundancy = np.maximum(redundancy, similarity)
+
+        kept = [docs[i] for i in picked]
+        return PackedContext(
+            text=build_context(kept),
+            documents=kept,
+            tokens=used,
+            duplicates=duplicates,
+            over_budget=over_budget,
+        )
@@ -19,14 +19,15 @@ def main():
     
     print("Loading RAG system...")
     rag = RAGSystem("config.yaml")
+    partition = rag.get_partition()
     
-    if not rag.all_documents:
+    if not len(partition.store):
         print("Error: No documents have been ingested yet.")
         print("Please run pipeline.py first and ingest some documents.")
         sys.exit(1)
     
-    print(f"Total documents indexed: {len(rag.all_documents)}")
-    print(f"Total estimated tokens: {rag.total_tokens}")
+    print(f"Total documents indexed: {len(partition.store)}")
+    print(f"Total estimated tokens: {partition.total_tokens}")
     
     rag.debug_retrieval(query)
 
@@ -0,0 +1,258 @@
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain.schema import Document
+
+from ai.token_counter import count_tokens, get_token_counter
+
+# Index entry: offset of the record in the segment, length of the metadata JSON, length of the text
+_ENTRY = struct.Struct("<QII")
+
+
+class DocumentStore:
+    """
+    Append-only page store.
+    Page records (metadata JSON followed by UTF-8 text) are appended to a segment file that is
+    read through mmap, and a fixed-width offset index locates each record, so ingest writes only
+    the new pages and opening the store does not materialize any Document.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.segment_path = os.path.join(directory, "documents.seg")
+        self.index_path = os.path.join(directory, "documents.idx")
+        self.meta_path = os.path.join(directory, "documents.meta.json")
+        self.tokens_path = os.path.join(directory, "documents.tokens")
+        self.deleted_path = os.path.join(directory, "documents.deleted")
+
+        self._lock = threading.RLock()
+        self._entries: List[tuple] = []
+        self._tokens = array("I")  # tokens per page, parallel to the index, counted once at ingest
+        self._deleted = set()  # tombstoned positions
+        self._live_bytes = 0  # metadata + text bytes of the live pages, kept up to date by append and delete_source
+        self._sources: Optional[Dict[str, List[int]]] = None  # source -> positions, built on first use
+        self._page_positions: Dict[tuple, int] = {}  # (source, page number) -> position, built with _sources
+        self._source_tokens: Dict[str, int] = {}
+        self._mmap = None
+        self._mapped_size = 0
+        self.meta: Dict[str, Any] = {}
+
+        self._open()
+
+    def _open(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+
+        if not os.path.exists(self.index_path):
+            return
+
+        segment_size = os.path.getsize(self.segment_path) if os.path.exists(self.segment_path) else 0
+        with open(self.index_path, "rb") as f:
+            raw = f.read()
+
+        valid_bytes = len(raw) - len(raw) % _ENTRY.size
+        for (offset, meta_len, text_len) in _ENTRY.iter_unpack(raw[:valid_bytes]):
+            # Entries written after a torn segment append are dropped
+            if offset + meta_len + text_len > segment_size:
+                break
+            self._entries.append((offset, meta_len, text_len))
+
+        if len(self._entries) * _ENTRY.size != len(raw):
+            with open(self.index_path, "r+b") as f:
+                f.truncate(len(self._entries) * _ENTRY.size)
+
+        token_bytes = b""
+        counter_name = get_token_counter().name
+        # Counts cached by another counting method (or by older versions, which used len/4) are redone once
+        if os.path.exists(self.tokens_path) and self.meta.get("token_counter") == counter_name:
+            with open(self.tokens_path, "rb") as f:
+                token_bytes = f.read()
+        self._tokens.frombytes(token_bytes[:len(self._entries) * self._tokens.itemsize])
+        if len(self._tokens) < len(self._entries):
+            self._tokens.extend(array("I", (
+                count_tokens(self.get_text(position))
+                for position in range(len(self._tokens), len(self._entries))
+            )))
+        if len(self._tokens) * self._tokens.itemsize != len(token_bytes):
+            with open(self.tokens_path, "wb") as f:
+                self._tokens.tofile(f)
+        if self.meta.get("token_counter") != counter_name:
+            self.save_meta(token_counter=counter_name)
+
+        if os.path.exists(self.deleted_path):
+            deleted = array("I")
+            with open(self.deleted_path, "rb") as f:
+                raw = f.read()
+            deleted.frombytes(raw[:len(raw) - len(raw) % deleted.itemsize])
+            self._deleted = set(deleted)
+
+        self._live_bytes = sum(
+            meta_len + text_len
+            for position, (_, meta_len, text_len) in enumerate(self._entries)
+            if position not in self._deleted
+        )
+
+    def exists(self) -> bool:
+        return os.path.exists(self.index_path)
+
+    def __len__(self) -> int:
+        """Number of live (not deleted) pages."""
+        return len(self._entries) - len(self._deleted)
+
+    def positions(self) -> List[int]:
+        return [position for position in range(len(self._entries)) if position not in self._deleted]
+
+    @property
+    def data_bytes(self) -> int:
+        return self._live_bytes
+
+    def _view(self, end: int):
+        # The mapping is widened lazily when appends grow the segment past the mapped size
+        if self._mmap is None or end > self._mapped_size:
+            with self._lock:
+                if self._mmap is None or end > self._mapped_size:
+                    with open(self.segment_path, "rb") as f:
+                        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._mapped_size = len(self._mmap)
+        return self._mmap
+
+    def page_tokens(self, position: int) -> int:
+        return self._tokens[position]
+
+    @property
+    def total_tokens(self) -> int:
+        """Tokens of every live page."""
+        self._ensure_sources()
+        return sum(self._source_tokens.values())
+
+    def _ensure_sources(self):
+        if self._sources is None:
+            with self._lock:
+                if self._sources is None:
+                    sources: Dict[str, List[int]] = {}
+                    source_tokens: Dict[str, int] = {}
+                    page_positions: Dict[tuple, int] = {}
+                    for position in self.positions():
+                        metadata = self.get_metadata(position)
+                        source = metadata.get("source", "Unknown")
+                        sources.setdefault(source, []).append(position)
+                        source_tokens[source] = source_tokens.get(source, 0) + self._tokens[position]
+                        page_positions[(source, metadata.get("page"))] = position
+                    self._source_tokens = source_tokens
+                    self._page_positions = page_positions
+                    self._sources = sources
+
+    def sources(self) -> List[str]:
+        self._ensure_sources()
+        return list(self._sources)
+
+    def source_positions(self, source: str) -> List[int]:
+        self._ensure_sources()
+        return self._sources.get(source, [])
+
+    def source_tokens(self, source: str) -> int:
+        self._ensure_sources()
+        return self._source_tokens.get(source, 0)
+
+    def page_position(self, source: str, page: Any) -> Optional[int]:
+        """Position of a live page by its (source, page number) metadata, e.g. for a docstore copy of it."""
+        self._ensure_sources()
+        return self._page_positions.get((source, page))
+
+    def get_metadata(self, position: int) -> Dict[str, Any]:
+        offset, meta_len, _ = self._entries[position]
+        view = self._view(offset + meta_len)
+        return json.loads(view[offset:offset + meta_len])
+
+    def get_text(self, position: int) -> str:
+        offset, meta_len, text_len = self._entries[position]
+        start = offset + meta_len
+        view = self._view(start + text_len)
+        return view[start:start + text_len].decode("utf-8")
+
+    def get(self, position: int) -> Document:
+        return Document(page_content=self.get_text(position), metadata=self.get_metadata(position))
+
+    def get_many(self, positions: List[int]) -> List[Document]:
+        return [self.get(position) for position in positions]
+
+    def iter_documents(self) -> Iterator[Document]:
+        for position in self.positions():
+            yield self.get(position)
+
+    def append(self, documents: List[Document], tokens: Optional[List[int]] = None) -> List[int]:
+        """Append pages (with their token counts) and return their positions in the store."""
+        if tokens is None:
+            tokens = [count_tokens(doc.page_content) for doc in documents]
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            new_entries = []
+            with open(self.segment_path, "ab") as f:
+                offset = f.tell()
+                for doc in documents:
+                    meta = json.dumps(doc.metadata, ensure_ascii=False).encode("utf-8")
+                    text = doc.page_content.encode("utf-8")
+                    f.write(meta)
+                    f.write(text)
+                    new_entries.append((offset, len(meta), len(text)))
+                    offset += len(meta) + len(text)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # The index is only extended once the records it points to are durable
+            with open(self.index_path, "ab") as f:
+                f.write(b"".join(_ENTRY.pack(*entry) for entry in new_entries))
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(self.tokens_path, "ab") as f:
+                array("I", tokens).tofile(f)
+            if self.meta.get("token_counter") != get_token_counter().name:
+                self.save_meta(token_counter=get_token_counter().name)
+
+            start = len(self._entries)
+            self._entries.extend(new_entries)
+            self._tokens.extend(array("I", tokens))
+            self._live_bytes += sum(meta_len + text_len for _, meta_len, text_len in new_entries)
+            positions = list(range(start, len(self._entries)))
+
+            if self._sources is not None:
+                for doc, position, page_tokens in zip(documents, positions, tokens):
+                    source = doc.metadata.get("source", "Unknown")
+                    self._sources.setdefault(source, []).append(position)
+                    self._source_tokens[source] = self._source_tokens.get(source, 0) + page_tokens
+                    self._page_positions[(source, doc.metadata.get("page"))] = position
+            return positions
+
+    def delete_source(self, source: str) -> List[int]:
+        """Tombstone every page of a source and return their positions. Segments are not rewritten."""
+        self._ensure_sources()
+        with self._lock:
+            positions = self._sources.pop(source, [])
+            self._source_tokens.pop(source, None)
+            for position in positions:
+                key = (source, self.get_metadata(position).get("page"))
+                if self._page_positions.get(key) == position:
+                    del self._page_positions[key]
+            if positions:
+                with open(self.deleted_path, "ab") as f:
+                    array("I", positions).tofile(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._deleted.update(positions)
+                self._live_bytes -= sum(self._entries[p][1] + self._entries[p][2] for p in positions)
+            return positions
+
+    def save_meta(self, **values: Any):
+        os.makedirs(self.directory, exist_ok=True)
+        self.meta.update(values)
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
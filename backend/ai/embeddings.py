@@ -0,0 +1,165 @@
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from ai.registry import get_sentence_transformer
+
+# SQLite's default limit on bound parameters is 999
+_LOOKUP_BATCH = 900
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Persistent content-hash cache in front of an embedding model.
+    Vectors are stored by (model name, sha256 of the chunk text), so re-ingesting a file that was
+    already uploaded to any notebook only embeds chunks that were never seen before.
+    Queries are not cached.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.underlying = underlying
+        self.model_name = model_name
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, hash))"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _lookup(self, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), _LOOKUP_BATCH):
+                batch = hashes[start:start + _LOOKUP_BATCH]
+                placeholders = ",".join("?" for _ in batch)
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [self.model_name, *batch],
+                ).fetchall()
+                for digest, blob in rows:
+                    found[digest] = np.frombuffer(blob, dtype="float32").tolist()
+        return found
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [self._hash(text) for text in texts]
+        vectors = self._lookup(list(set(hashes)))
+
+        # Duplicates inside the batch are embedded once
+        missing = {}
+        for digest, text in zip(hashes, texts):
+            if digest not in vectors and digest not in missing:
+                missing[digest] = text
+        self.hits += len(texts) - sum(1 for digest in hashes if digest in missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_vectors = self.underlying.embed_documents(list(missing.values()))
+            rows = []
+            for digest, vector in zip(missing, new_vectors):
+                vector = np.asarray(vector, dtype="float32")
+                vectors[digest] = vector.tolist()
+                rows.append((self.model_name, digest, vector.tobytes()))
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)", rows
+                )
+                self._conn.commit()
+
+        return [vectors[digest] for digest in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.underlying.embed_query(text)
+
+    def stats(self) -> Dict[str, Any]:
+        """Cache hits and misses (in chunks), plus the model's own counters when it has any."""
+        underlying = self.underlying.stats() if hasattr(self.underlying, "stats") else {}
+        return {"cache_hits": self.hits, "cache_misses": self.misses, **underlying}
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    SentenceTransformer embeddings for ingestion.
+    Texts are passed as they come: SentenceTransformer.encode already sorts them by length so each
+    batch pads to similar lengths. With `num_workers` > 1 large inputs are sharded across a process
+    pool. Throughput is reported in chunks/sec and by `stats()`.
+    """
+
+    def __init__(self, model_name: str, device: str = "cpu", batch_size: int = 64, num_workers: int = 0):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.model = get_sentence_transformer(model_name, device)
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.total_chunks = 0
+        self.total_seconds = 0.0
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = self.model.start_multi_process_pool([self.device] * self.num_workers)
+                atexit.register(self.close)
+            return self._pool
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self.model.stop_multi_process_pool(self._pool)
+                self._pool = None
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        # Small inputs are not worth the inter-process transfer
+        if self.num_workers > 1 and len(texts) >= self.batch_size * self.num_workers:
+            return self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                pool=self._get_pool(),
+                chunk_size=max(self.batch_size, len(texts) // (self.num_workers * 4)),
+            )
+        return self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        # Same preprocessing as HuggingFaceEmbeddings, so vectors match indexes built with it
+        texts = [text.replace("\n", " ") for text in texts]
+
+        start = time.perf_counter()
+        vectors = self._encode(texts)
+        elapsed = time.perf_counter() - start
+
+        self.total_chunks += len(texts)
+        self.total_seconds += elapsed
+        print(f"Embedded {len(texts)} chunks in {elapsed:.2f}s ({len(texts) / max(elapsed, 1e-9):.1f} chunks/sec)")
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.encode(text.replace("\n", " "), convert_to_numpy=True).tolist()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "chunks": self.total_chunks,
+            "seconds": self.total_seconds,
+            "chunks_per_sec": self.total_chunks / self.total_seconds if self.total_seconds else 0.0,
+        }
@@ -0,0 +1,110 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+# A leg returns (document, raw score) pairs, best first
+Leg = Callable[[], List[Tuple[Document, float]]]
+Hit = Tuple[Document, float, Dict[str, float]]
+
+
+def fuse(
+    leg_results: Dict[str, List[Tuple[Document, float]]],
+    weights: Dict[str, float],
+    method: str = "rrf",
+    rrf_c: int = 60,
+    lower_is_better: Tuple[str, ...] = (),
+) -> List[Hit]:
+    """
+    Fuse ranked legs into (doc, fused_score, {leg: raw score}) sorted by fused score.
+    "rrf" is weighted reciprocal rank fusion; "score" sums the weighted, min-max normalized leg
+    scores (legs in `lower_is_better`, such as L2 distances, are flipped first).
+    Documents are deduplicated by content, as the legs return separate copies of the same page.
+    """
+    keys: Dict[str, int] = {}
+    docs: List[Document] = []
+    legs = [leg for leg, results in leg_results.items() if results]
+    for leg in legs:
+        for doc, _ in leg_results[leg]:
+            if doc.page_content not in keys:
+                keys[doc.page_content] = len(docs)
+                docs.append(doc)
+    if not docs:
+        return []
+
+    fused = np.zeros(len(docs))
+    raw = np.full((len(legs), len(docs)), np.nan)
+    for j, leg in enumerate(legs):
+        results = leg_results[leg]
+        rows = np.fromiter((keys[doc.page_content] for doc, _ in results), dtype=np.int64, count=len(results))
+        scores = np.fromiter((score for _, score in results), dtype=np.float64, count=len(results))
+        # A page can come back twice from one leg; its best (first) occurrence counts
+        rows, first = np.unique(rows, return_index=True)
+        scores = scores[first]
+        raw[j, rows] = scores
+
+        if method == "rrf":
+            contribution = 1.0 / (first + 1 + rrf_c)
+        else:
+            oriented = -scores if leg in lower_is_better else scores
+            spread = oriented.max() - oriented.min()
+            contribution = (oriented - oriented.min()) / spread if spread > 0 else np.ones(len(oriented))
+        fused[rows] += weights.get(leg, 1.0) * contribution
+
+    order = np.argsort(-fused, kind="stable")
+    return [
+        (docs[i], float(fused[i]), {leg: float(raw[j, i]) for j, leg in enumerate(legs) if not np.isnan(raw[j, i])})
+        for i in order
+    ]
+
+
+class HybridRetriever:
+    """
+    Runs the retrieval legs (dense, sparse) concurrently and fuses their scores.
+    Each leg has its own timeout; a leg that is late or fails is left out of the fusion instead of
+    failing the query, so latency is bounded by the slowest leg (or its timeout), not the sum.
+    """
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        method: str = "rrf",
+        rrf_c: int = 60,
+        leg_timeout_seconds: float = 5.0,
+        leg_timeouts: Optional[Dict[str, float]] = None,
+        max_workers: int = 8,
+        lower_is_better: Tuple[str, ...] = ("dense",),
+    ):
+        self.weights = weights or {"dense": 0.5, "sparse": 0.5}
+        self.method = method
+        self.rrf_c = rrf_c
+        self.leg_timeout_seconds = leg_timeout_seconds
+        # Per-leg overrides of leg_timeout_seconds
+        self.leg_timeouts = leg_timeouts or {}
+        self.lower_is_better = lower_is_better
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval-leg")
+
+    def run_legs(self, legs: Dict[str, Leg]) -> Dict[str, List[Tuple[Document, float]]]:
+        start = time.monotonic()
+        futures = {name: self.executor.submit(leg) for name, leg in legs.items()}
+        results = {}
+        for name, future in futures.items():
+            timeout = self.leg_timeouts.get(name, self.leg_timeout_seconds)
+            try:
+                # Timeouts count from the common start, not from when the previous leg was collected
+                results[name] = future.result(timeout=max(start + timeout - time.monotonic(), 0))
+            except FutureTimeoutError:
+                print(f"Retrieval leg {name} timed out after {timeout}s")
+                results[name] = []
+            except Exception as e:
+                print(f"Retrieval leg {name} failed: {e}")
+                results[name] = []
+        return results
+
+    def search(self, legs: Dict[str, Leg], k: Optional[int] = None) -> List[Hit]:
+        """Fused hits of every leg, or the top `k`."""
+        results = self.run_legs(legs)
+        hits = fuse(results, self.weights, self.method, self.rrf_c, lower_is_better=self.lower_is_better)
+        return hits if k is None else hits[:k]
@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+_DONE = object()
+
+
+class PipelineStage:
+    """
+    One step of a `StagedPipeline`.
+    `fn(item)` returns the item passed downstream, or None to drop it. With `collect=True` the stage
+    instead takes everything already waiting in its queue (up to `max_items`) as one list, which
+    lets the embed and index steps batch across files without waiting for slow ones.
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], workers: int = 1, collect: bool = False, max_items: int = 64):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.collect = collect
+        self.max_items = max_items
+
+        self._lock = threading.Lock()
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        # Time spent blocked on a full downstream queue, i.e. how much this stage was throttled
+        self.blocked_seconds = 0.0
+
+    def stats(self, wall_seconds: float) -> Dict[str, Any]:
+        return {
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "blocked_seconds": round(self.blocked_seconds, 3),
+            "items_per_second": round(self.items_in / wall_seconds, 2) if wall_seconds else 0.0,
+        }
+
+
+class StagedPipeline:
+    """
+    Threads connected by bounded queues. An item moves to the next stage as soon as it is done,
+    and a full queue blocks the stage upstream of it, so at most `queue_size` items wait between
+    two stages. If any stage raises, the remaining items are drained without being processed
+    and `run` re-raises the first error.
+    """
+
+    def __init__(self, stages: List[PipelineStage], queue_size: int = 4):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.wall_seconds = 0.0
+        self._error: Optional[BaseException] = None
+        self._error_lock = threading.Lock()
+
+    def run(self, items: Iterable[Any]):
+        start = time.perf_counter()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        remaining_lock = threading.Lock()
+
+        def put(index: int, item: Any, stage: Optional[PipelineStage] = None):
+            if index == len(self.stages):
+                return
+            wait_start = time.perf_counter()
+            queues[index].put(item)
+            if stage is not None:
+                with stage._lock:
+                    stage.blocked_seconds += time.perf_counter() - wait_start
+
+        def worker(index: int):
+            stage = self.stages[index]
+            done = False
+            while not done:
+                batch = [queues[index].get()]
+                if stage.collect:
+                    while len(batch) < stage.max_items and batch[-1] is not _DONE:
+                        try:
+                            batch.append(queues[index].get_nowait())
+                        except queue.Empty:
+                            break
+                if batch[-1] is _DONE:
+                    batch.pop()
+                    done = True
+                if batch and self._error is None:
+                    self._process(stage, batch, lambda out: put(index + 1, out, stage))
+
+            with remaining_lock:
+                remaining[index] -= 1
+                last = remaining[index] == 0
+            if last:
+                for _ in range(self.stages[index + 1].workers if index + 1 < len(self.stages) else 0):
+                    put(index + 1, _DONE)
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(target=worker, args=(index,), name=f"ingest-{stage.name}-{n}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            if self._error is not None:
+                break
+            put(0, item)
+        for _ in range(self.stages[0].workers):
+            put(0, _DONE)
+        for thread in threads:
+            thread.join()
+
+        self.wall_seconds = time.perf_counter() - start
+        if self._error is not None:
+            raise self._error
+
+    def _process(self, stage: PipelineStage, batch: List[Any], emit: Callable[[Any], None]):
+        with stage._lock:
+            stage.items_in += len(batch)
+        busy_start = time.perf_counter()
+        try:
+            out = stage.fn(batch if stage.collect else batch[0])
+        except BaseException as e:
+            with self._error_lock:
+                if self._error is None:
+                    print(f"Ingest stage {stage.name} failed: {e}")
+                    self._error = e
+            return
+        finally:
+            with stage._lock:
+                stage.busy_seconds += time.perf_counter() - busy_start
+        if out is not None:
+            with stage._lock:
+                stage.items_out += 1
+            emit(out)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "wall_seconds": round(self.wall_seconds, 3),
+            "stages": {stage.name: stage.stats(self.wall_seconds) for stage in self.stages},
+        }
+
+    def print_stats(self):
+        print(f"Ingest pipeline finished in {self.wall_seconds:.2f}s")
+        for stage in self.stages:
+            s = stage.stats(self.wall_seconds)
+            print(
+                f"  {stage.name:<6} in={s['items_in']:<5} out={s['items_out']:<5} "
+                f"busy={s['busy_seconds']:.2f}s blocked={s['blocked_seconds']:.2f}s {s['items_per_second']}/s"
+            )
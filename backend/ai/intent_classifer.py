@@ -1,12 +1,16 @@
 import joblib
-from sentence_transformers import SentenceTransformer
-encoder = SentenceTransformer('all-MiniLM-L6-v2')
+from ai.registry import get_sentence_transformer
+
+_classifier = None
+
 def route_query(user_query):
-    file_path = './intent_router.pkl'
-    classifier = joblib.load(file_path)
+    global _classifier
+    if _classifier is None:
+        _classifier = joblib.load('./intent_router.pkl')
+    encoder = get_sentence_transformer('all-MiniLM-L6-v2')
     query_embedding = encoder.encode([user_query])
-    prediction = classifier.predict(query_embedding)[0]
-    prob = classifier.predict_proba(query_embedding)[0]
+    prediction = _classifier.predict(query_embedding)[0]
+    prob = _classifier.predict_proba(query_embedding)[0]
     if max(prob) < 0.7:
         return "Unsure"
 
@@ -0,0 +1,108 @@
+import csv
+import json
+import os
+from typing import Callable, Dict, Iterable, Iterator, List
+
+# Plain-text formats need no OCR or layout analysis; they are parsed locally into page-sized units
+# instead of being sent to LlamaParse
+PAGE_CHARS = 4000
+CSV_ROWS_PER_PAGE = 50
+
+
+def _split_long_lines(lines: Iterable[str], page_chars: int) -> Iterator[str]:
+    """Lines longer than two pages (minified JSON, text without newlines) cut into page-sized pieces at spaces."""
+    for line in lines:
+        while len(line) > 2 * page_chars:
+            cut = line.rfind(" ", page_chars // 2, page_chars)
+            cut = cut + 1 if cut != -1 else page_chars
+            yield line[:cut]
+            line = line[cut:]
+        yield line
+
+
+def _pack_lines(lines: Iterable[str], page_chars: int, is_break: Callable[[str], bool]) -> Iterator[str]:
+    """
+    Group streamed lines into pages of about `page_chars`.
+    A page is closed at the first break line (blank line, heading) after it is full, so paragraphs
+    stay whole; a page with no break at all is cut at twice the size, and so is a single long line.
+    """
+    page: List[str] = []
+    size = 0
+    for line in _split_long_lines(lines, page_chars):
+        if page and size >= page_chars and (is_break(line) or size >= 2 * page_chars):
+            yield "".join(page)
+            page, size = [], 0
+        page.append(line)
+        size += len(line)
+    if page:
+        yield "".join(page)
+
+
+def _page(text: str) -> Dict[str, str]:
+    return {"text": text, "md": text}
+
+
+def parse_text(path: str, page_chars: int = PAGE_CHARS) -> List[Dict[str, str]]:
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return [_page(text) for text in _pack_lines(f, page_chars, lambda line: not line.strip())]
+
+
+def parse_markdown(path: str, page_chars: int = PAGE_CHARS) -> List[Dict[str, str]]:
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return [
+            _page(text)
+            for text in _pack_lines(f, page_chars, lambda line: not line.strip() or line.startswith("#"))
+        ]
+
+
+def parse_csv(path: str, rows_per_page: int = CSV_ROWS_PER_PAGE) -> List[Dict[str, str]]:
+    """Rows grouped into pages, each page repeating the header so its chunks keep the column names."""
+    pages = []
+    with open(path, "r", encoding="utf-8", errors="replace", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return pages
+        header_line = " | ".join(header)
+        rows: List[str] = []
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            rows.append(" | ".join(row))
+            if len(rows) == rows_per_page:
+                pages.append(_page("\n".join([header_line] + rows) + "\n"))
+                rows = []
+        if rows or not pages:
+            pages.append(_page("\n".join([header_line] + rows) + "\n"))
+    return pages
+
+
+def parse_json(path: str, page_chars: int = PAGE_CHARS) -> List[Dict[str, str]]:
+    """Top-level list items (or object keys) pretty-printed and packed into pages."""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        data = json.load(f)
+
+    if isinstance(data, list):
+        items = (json.dumps(item, ensure_ascii=False, indent=2) + "\n" for item in data)
+    elif isinstance(data, dict):
+        items = (
+            f"{json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False, indent=2)}\n"
+            for key, value in data.items()
+        )
+    else:
+        items = iter([json.dumps(data, ensure_ascii=False) + "\n"])
+    return [_page(text) for text in _pack_lines(items, page_chars, lambda item: True)]
+
+
+LOCAL_PARSERS: Dict[str, Callable[[str], List[Dict[str, str]]]] = {
+    "txt": parse_text,
+    "md": parse_markdown,
+    "csv": parse_csv,
+    "json": parse_json,
+}
+
+
+def get_local_parser(path: str):
+    """The local parser for `path`'s extension, or None when the file needs LlamaParse."""
+    ext = os.path.splitext(path)[1].lstrip(".").lower()
+    return LOCAL_PARSERS.get(ext)
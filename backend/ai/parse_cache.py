@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """
+    On-disk cache of parse results keyed by (file sha256, parser settings).
+    Each entry is a JSON file holding the parsed pages and the token estimate, so the same file
+    uploaded again (to any notebook) skips the remote parse. Entries are evicted least recently
+    used first once the directory grows beyond `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._sizes: Dict[str, int] = {}
+        self._last_used: Dict[str, float] = {}
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(directory, name))
+                self._sizes[name] = stat.st_size
+                self._last_used[name] = stat.st_mtime
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(path: str, settings: Dict[str, Any]) -> str:
+        settings_digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+        return f"{file_sha256(path)}-{settings_digest[:16]}"
+
+    def _entry_path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, key: str):
+        """Return (pages, tokens, all_text) or None. Pages are dicts with "text" and "md"."""
+        name = f"{key}.json"
+        try:
+            with open(self._entry_path(name), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        now = time.time()
+        try:
+            # The file mtime keeps the LRU order across restarts
+            os.utime(self._entry_path(name), (now, now))
+        except OSError:
+            # Evicted by another thread after it was read; the entry is still valid for this caller
+            pass
+        with self._lock:
+            self.hits += 1
+            if name in self._sizes:
+                self._last_used[name] = now
+        return entry["pages"], entry["tokens"], entry["all_text"]
+
+    def put(self, key: str, pages: List[Dict[str, Any]], tokens: int, all_text: str):
+        name = f"{key}.json"
+        data = json.dumps({"pages": pages, "tokens": tokens, "all_text": all_text}, ensure_ascii=False).encode("utf-8")
+        tmp_path = self._entry_path(f"{name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._entry_path(name))
+
+        with self._lock:
+            self._sizes[name] = len(data)
+            self._last_used[name] = time.time()
+            while sum(self._sizes.values()) > self.max_bytes and len(self._sizes) > 1:
+                victim = min((n for n in self._sizes if n != name), key=lambda n: self._last_used[n])
+                try:
+                    os.remove(self._entry_path(victim))
+                except OSError:
+                    pass
+                self._sizes.pop(victim)
+                self._last_used.pop(victim)
+                self.evictions += 1
+
+    def get_or_parse(
+        self,
+        path: str,
+        settings: Dict[str, Any],
+        parse: Callable[[str], Tuple[List[Dict[str, Any]], int, str]],
+    ) -> Tuple[List[Dict[str, Any]], int, str]:
+        """Cached result for `path`, calling `parse(path)` -> (pages, tokens, all_text) on a miss."""
+        key = self.make_key(path, settings)
+        cached = self.get(key)
+        if cached is not None:
+            print(f"Parse cache hit: {path}")
+            return cached
+        pages, tokens, all_text = parse(path)
+        self.put(key, pages, tokens, all_text)
+        return pages, tokens, all_text
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._sizes),
+                "bytes": sum(self._sizes.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
@@ -1,8 +1,11 @@
 from llama_cloud_services import LlamaParse
 import os
-import concurrent.futures
 import json
 import re
+import time
+
+from ai.local_parsers import get_local_parser
+from ai.token_counter import count_tokens
 
 def estimate_tokens_locally(parsed_json_data):
     if isinstance(parsed_json_data, str):
@@ -15,33 +18,53 @@ def estimate_tokens_locally(parsed_json_data):
             all_text += page.get("md", "") + "\n\n"
     else:
         all_text = str(data)
-    estimated_count = len(all_text) / 3.6
-    
-    return int(estimated_count), all_text
+    return count_tokens(all_text), all_text
+
+# Part of the parse cache key: changing any setting re-parses files instead of serving stale results
+LLAMA_PARSE_SETTINGS = {
+    "language": "en",
+    "max_pages": 100,
+    "parse_mode": "parse_page_with_agent",
+    "model": "openai-gpt-4-1-mini",
+    "high_res_ocr": False,
+    "take_screenshot": 0,
+    "adaptive_long_table": True,
+    "outlined_table_extraction": True,
+    "output_tables_as_HTML": True,
+    "precise_bounding_box": True,
+}
 
-def parse_single_path(path):
+def parse_remote(path):
+    """LlamaParse a file into plain page dicts ({"text", "md"}), the format stored in the parse cache."""
     api_key = os.environ.get("LLAMA_PARSE_API_KEY") 
     
     if not api_key:
         raise ValueError("LLAMA_PARSE_API_KEY environment variable not set.")
-    parser = LlamaParse(
-  api_key=api_key,
-    language="en",
-    max_pages=100,
-    parse_mode="parse_page_with_agent",
-    model="openai-gpt-4-1-mini",
-    high_res_ocr=False,
-    take_screenshot=0,
-    adaptive_long_table=True,
-    outlined_table_extraction=True,
-    output_tables_as_HTML=True,
-    precise_bounding_box=True,
-    )
+    parser = LlamaParse(api_key=api_key, **LLAMA_PARSE_SETTINGS)
     print(f"Submitting job for: {path}")
     result = parser.parse(file_path=path)
-    estimated_tokens, all_text = estimate_tokens_locally(result)
+    pages = [{"text": page.text or "", "md": page.md or ""} for page in (result.pages or [])]
+    estimated_tokens, all_text = estimate_tokens_locally({"pages": pages})
     print(f"Finished parsing: {path}")
-    return result, estimated_tokens, all_text
+    return pages, estimated_tokens, all_text
+
+def parse_local(path, local_parser):
+    start = time.perf_counter()
+    pages = local_parser(path)
+    estimated_tokens, all_text = estimate_tokens_locally({"pages": pages})
+    print(f"Parsed locally: {path} ({len(pages)} pages, {(time.perf_counter() - start) * 1000:.1f} ms)")
+    return pages, estimated_tokens, all_text
+
+def parse_single_path(path, cache=None):
+    # txt/md/csv/json are parsed in-process; only PDF/DOCX/PPTX (and anything unknown) go to LlamaParse
+    local_parser = get_local_parser(path)
+    if local_parser is not None:
+        pages, estimated_tokens, all_text = parse_local(path, local_parser)
+    elif cache is not None:
+        pages, estimated_tokens, all_text = cache.get_or_parse(path, LLAMA_PARSE_SETTINGS, parse_remote)
+    else:
+        pages, estimated_tokens, all_text = parse_remote(path)
+    return {"pages": pages}, estimated_tokens, all_text
 
 def remove_footer(text):
     '''
@@ -50,35 +73,3 @@ def remove_footer(text):
     clean_text = re.sub(r"Downloaded by .*? on .*? CDT", "", text, flags=re.IGNORECASE)
     clean_text = re.sub(r"\n\s*\n", "\n\n", clean_text)
     return clean_text
-
-def results_into_list_of_strings(results):
-    list_of_strings = {}
-    for key in results:
-        pages = results[key][0].pages
-        combined_text = ""
-        number_of_pages = 1
-        for page in pages:
-            combined_text = "Page" + str(number_of_pages) + "\n" + combined_text + remove_footer(page.text) + "\n" 
-            number_of_pages += 1
-        list_of_strings[key] = [combined_text], results[key][1]
-    return list_of_strings
-
-# --- Function to parse multiple files in parallel ---
-def parse_multiple_paths_parallel(path_list, max_workers=10):
-    all_results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_path = {executor.submit(parse_single_path, path): path for path in path_list}
-        
-        # As results complete, they are yielded by concurrent.futures.as_completed
-        for future in concurrent.futures.as_completed(future_to_path):
-            path = future_to_path[future]
-            try:
-                # Get the result from the completed future
-                data, estimated_tokens, all_text = future.result()
-                all_results[path] = (data, estimated_tokens, all_text)
-            except Exception as exc:
-                # Handle any exceptions that occurred during parsing
-                print(f'{path} generated an exception: {exc}')
-                all_results[path] = f'Error: {exc}'
-
-    return all_results
\ No newline at end of file
@@ -0,0 +1,523 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Collection, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from langchain.retrievers import ParentDocumentRetriever
+from langchain.schema import Document
+
+from ai.bm25_index import BM25Index
+from ai.docstore import SQLiteDocStore
+from ai.hybrid_retriever import HybridRetriever, Hit
+from ai.document_store import DocumentStore
+from ai.rag_modules import VectorDBClient
+
+DEFAULT_PARTITION = "default"
+
+
+class PartitionSnapshot:
+    """
+    Immutable view of a partition's indexes at one corpus version.
+    A query takes the current snapshot once and runs every step against it without locking. Writers
+    build the next version beside it (FAISS segments, copy-on-write BM25, new source maps)
+    and publish it by swapping a single reference, so a query never sees a half-applied ingest or delete.
+    """
+
+    def __init__(
+        self,
+        partition: "NotebookPartition",
+        version: int,
+        vectorstore: Any,
+        source_vector_ids: Dict[str, List[int]],
+        sources: Dict[str, List[int]],
+        source_tokens: Dict[str, int],
+        bm25_index: Optional[BM25Index] = None,
+    ):
+        self.partition = partition
+        self.version = version
+        self.vectorstore = vectorstore
+        self.source_vector_ids = source_vector_ids
+        self.sources = sources
+        # Per-page counts are cached by the document store, so both totals are sums of cached counts
+        self.source_token_counts = source_tokens
+        self.total_tokens = sum(source_tokens.values())
+        self.positions = sorted(position for source_positions in sources.values() for position in source_positions)
+        self._bm25_index = bm25_index
+        self._bm25_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of live pages."""
+        return len(self.positions)
+
+    @property
+    def notebook_id(self) -> str:
+        return self.partition.notebook_id
+
+    @property
+    def bm25_index(self) -> BM25Index:
+        # Built in the background when the partition loads (see NotebookPartition._build_bm25), or
+        # here on first use; later snapshots copy it instead of rebuilding
+        if self._bm25_index is None:
+            with self._bm25_lock:
+                if self._bm25_index is None:
+                    store = self.partition.store
+                    index = BM25Index(**self.partition.bm25_config)
+                    index.add_texts((store.get_text(p) for p in self.positions), ids=self.positions)
+                    self._bm25_index = index
+        return self._bm25_index
+
+    @property
+    def bm25_built(self) -> bool:
+        return self._bm25_index is not None
+
+    def list_sources(self) -> List[str]:
+        return sorted(self.sources)
+
+    def resolve_sources(self, file_filters: List[str]) -> List[str]:
+        """Sources matching any of the (partial filename) filters."""
+        return [source for source in self.sources if any(f in source for f in file_filters)]
+
+    def source_positions(self, sources: List[str]) -> List[int]:
+        return [position for source in sources for position in self.sources.get(source, [])]
+
+    def source_tokens(self, sources: List[str]) -> int:
+        return sum(self.source_token_counts.get(source, 0) for source in sources)
+
+    def document_positions(self, sources: Optional[List[str]] = None) -> List[int]:
+        """Store positions of the given sources' pages (all pages when None), in ingestion order."""
+        return self.positions if sources is None else sorted(self.source_positions(sources))
+
+    def documents(self, sources: Optional[List[str]] = None) -> List[Document]:
+        """Pages of the given sources (all pages when None), in ingestion order."""
+        return self.partition.store.get_many(self.document_positions(sources))
+
+    def page_tokens(self, docs: List[Document]) -> List[Optional[int]]:
+        """
+        Cached token counts of `docs` by their (source, page) metadata, for the context packer.
+        None for a page the store no longer holds.
+        """
+        store = self.partition.store
+        counts: List[Optional[int]] = []
+        for doc in docs:
+            position = store.page_position(doc.metadata.get("source", "Unknown"), doc.metadata.get("page"))
+            counts.append(None if position is None else store.page_tokens(position))
+        return counts
+
+    def retrieve(self, query: str, file_filters: Optional[List[str]] = None, query_embedding: Optional[List[float]] = None) -> List[Document]:
+        """Pages of `search`, best first."""
+        return [doc for doc, _, _ in self.search(query, file_filters, query_embedding)]
+
+    def search(self, query: str, file_filters: Optional[List[str]] = None, query_embedding: Optional[List[float]] = None) -> List[Hit]:
+        """
+        Hybrid dense + BM25 retrieval. Both legs run concurrently and are fused by the partition's
+        HybridRetriever into (page, fused score, {"dense": L2 distance, "sparse": BM25 score}).
+        With file filters both legs only search the selected sources, so k hits come from those files.
+        Pass `query_embedding` when the query was already embedded (see QueryContext).
+        """
+        vector_ids = positions = None
+        if file_filters:
+            sources = self.resolve_sources(file_filters)
+            if not sources:
+                return []
+            vector_ids = [i for source in sources for i in self.source_vector_ids.get(source, [])]
+            positions = set(self.source_positions(sources))
+
+        # A cold index is built (or its background build awaited) before the legs start, so the
+        # build is not counted against the sparse leg's timeout and does not drop the leg
+        self.bm25_index
+        k = self.partition.retrieval_k
+        return self.partition.retriever.search({
+            "dense": lambda: self.dense_search(query, k, vector_ids, query_embedding),
+            "sparse": lambda: self.sparse_search(query, k, positions),
+        })
+
+    def dense_search(self, query: str, k: int, vector_ids: Optional[List[int]] = None, query_embedding: Optional[List[float]] = None) -> List[Tuple[Document, float]]:
+        """Vector search over child chunks, collapsed to (parent page, best child L2 distance)."""
+        partition = self.partition
+        embedding = query_embedding if query_embedding is not None else partition.embeddings.embed_query(query)
+        # Several children usually share a parent, so over-fetch before collapsing
+        children = partition.vector_db_client.search_by_vector(embedding, k * 4, ids=vector_ids, vectorstore=self.vectorstore)
+        parent_distances: Dict[str, float] = {}
+        for child, distance in children:
+            parent_id = child.metadata.get(partition.parent_retriever.id_key)
+            if parent_id is not None and parent_id not in parent_distances:
+                parent_distances[parent_id] = distance
+        parent_ids = list(parent_distances)[:k]
+        return [
+            (doc, parent_distances[parent_id])
+            for parent_id, doc in zip(parent_ids, partition.docstore.mget(parent_ids))
+            if doc is not None
+        ]
+
+    def sparse_search(self, query: str, k: int, positions: Optional[Collection[int]] = None) -> List[Tuple[Document, float]]:
+        """BM25 over whole pages: (page, score)."""
+        hits = self.bm25_index.search(query, k, allowed_ids=positions)
+        docs = self.partition.store.get_many([position for position, _ in hits])
+        return [(doc, score) for doc, (_, score) in zip(docs, hits)]
+
+
+class NotebookPartition:
+    """
+    Retrieval indexes (FAISS, BM25, docstore) for a single notebook.
+    Each partition persists to its own directory so notebooks never search each other's vectors.
+    Reads go through `snapshot()`; ingest and delete are serialized and publish a new snapshot.
+    """
+
+    def __init__(
+        self,
+        notebook_id: str,
+        index_path: str,
+        store_path: str,
+        embeddings: Any,
+        child_splitter: Any,
+        retrieval_k: int,
+        legacy_docs_path: Optional[str] = None,
+        vector_index_config: Optional[dict] = None,
+        bm25_config: Optional[dict] = None,
+        retriever: Optional[HybridRetriever] = None,
+    ):
+        self.notebook_id = notebook_id
+        self.index_path = index_path
+        self.embeddings = embeddings
+        self.retrieval_k = retrieval_k
+        # BM25Index keyword arguments (k1, b, analyzer)
+        self.bm25_config = bm25_config or {}
+        self.retriever = retriever or HybridRetriever()
+
+        self.vector_db_client = VectorDBClient(
+            index_path=self.index_path,
+            embedding_function=embeddings,
+            index_config=vector_index_config
+        )
+
+        # Parent pages are persisted next to the FAISS index so child hits survive restarts
+        self.docstore = SQLiteDocStore(os.path.join(self.index_path, "parents.sqlite"))
+
+        # Only used to split pages into child chunks tagged with their parent id
+        self.parent_retriever = ParentDocumentRetriever(
+            vectorstore=self.vectorstore.base,
+            docstore=self.docstore,
+            child_splitter=child_splitter,
+        )
+
+        self.store = DocumentStore(store_path)
+        if not self.store.exists() and legacy_docs_path:
+            self._migrate_pickle(legacy_docs_path)
+        print(f"Opened {len(self.store)} documents from {store_path}")
+
+        if len(self.store) and self.vectorstore.ntotal and not len(self.docstore):
+            self._backfill_parents()
+
+        self._write_lock = threading.Lock()
+        # FAISS ids of the child chunks of each source, used to restrict vector search to selected files
+        source_vector_ids = {}
+        self._map_vector_ids(self.vectorstore, range(self.vectorstore.ntotal), source_vector_ids)
+        # Sparse index is built once in the background from the first snapshot; each write waits for
+        # it, then copies it and updates the copy incrementally
+        self._snapshot = self._make_snapshot(source_vector_ids, bm25_index=None)
+        self._build_bm25(self._snapshot)
+
+    def snapshot(self) -> PartitionSnapshot:
+        """The current index snapshot. Hold on to it for the duration of a query."""
+        return self._snapshot
+
+    @property
+    def vectorstore(self):
+        return self.vector_db_client.vectorstore
+
+    @property
+    def total_tokens(self) -> int:
+        return self._snapshot.total_tokens
+
+    @property
+    def version(self) -> int:
+        """Corpus version, bumped on every ingest or delete; used to key derived caches."""
+        return self._snapshot.version
+
+    @property
+    def bm25_index(self) -> BM25Index:
+        return self._snapshot.bm25_index
+
+    def _build_bm25(self, snapshot: PartitionSnapshot):
+        """
+        Build the first snapshot's BM25 index off the query path, so the first search does not pay for
+        it. Called once per partition; later snapshots inherit an updated copy.
+        """
+        if not snapshot.bm25_built and len(snapshot):
+            threading.Thread(
+                target=lambda: snapshot.bm25_index, name=f"bm25-{self.notebook_id}", daemon=True
+            ).start()
+
+    def _make_snapshot(self, source_vector_ids: Dict[str, List[int]], bm25_index: Optional[BM25Index]) -> PartitionSnapshot:
+        sources = {source: list(self.store.source_positions(source)) for source in self.store.sources()}
+        return PartitionSnapshot(
+            self,
+            version=self.store.meta.get("version", 0),
+            vectorstore=self.vectorstore,
+            source_vector_ids=source_vector_ids,
+            sources=sources,
+            source_tokens={source: self.store.source_tokens(source) for source in sources},
+            bm25_index=bm25_index,
+        )
+
+    @staticmethod
+    def _map_vector_ids(vectorstore: Any, vector_ids: Iterable[int], source_vector_ids: Dict[str, List[int]]):
+        for vector_id in vector_ids:
+            child = vectorstore.child(vector_id)
+            if isinstance(child, Document):
+                source = child.metadata.get("source", "Unknown")
+                source_vector_ids.setdefault(source, []).append(vector_id)
+
+    def _migrate_pickle(self, docs_path: str):
+        """One-off import of the pickled documents list written by older versions."""
+        if not os.path.exists(docs_path):
+            return
+        try:
+            with open(docs_path, "rb") as f:
+                state = pickle.load(f)
+        except Exception as e:
+            print(f"Error loading state: {e}")
+            return
+        documents = state.get("documents", [])
+        self.store.append(documents)
+        print(f"Migrated {len(documents)} documents from {docs_path}")
+
+    def _backfill_parents(self):
+        """
+        Indexes written before the docstore was persisted only kept child vectors.
+        Rebuild their parents from the document store by (source, page) instead of re-embedding.
+        """
+        parent_keys = {}
+        for child in self.vectorstore.children():
+            if not isinstance(child, Document):
+                continue
+            parent_id = child.metadata.get(self.parent_retriever.id_key)
+            if parent_id is not None:
+                parent_keys[(child.metadata.get("source"), child.metadata.get("page"))] = parent_id
+
+        pairs = []
+        for doc in self.store.iter_documents():
+            parent_id = parent_keys.get((doc.metadata.get("source"), doc.metadata.get("page")))
+            if parent_id is not None:
+                pairs.append((parent_id, doc))
+        self.docstore.mset(pairs)
+        print(f"Restored {len(pairs)} parent documents into {self.docstore.path}")
+
+    def split_documents(self, documents: List[Document]) -> Tuple[List[Document], List[Tuple[str, Document]]]:
+        """Child chunks tagged with their parent id, and the (parent id, page) pairs for the docstore."""
+        return self.parent_retriever._split_docs_for_adding(documents)
+
+    def index_chunks(
+        self,
+        documents: List[Document],
+        children: List[Document],
+        parents: List[Tuple[str, Document]],
+        vectors: List[List[float]],
+        page_tokens: Optional[List[int]] = None,
+    ):
+        """
+        Write already split and embedded pages to every index and publish the next snapshot.
+        `page_tokens` are the pages' token counts if already known; they are counted otherwise.
+        """
+        with self._write_lock:
+            current = self._snapshot
+            # Waits for a background build in flight, then the new pages are added to a copy
+            bm25_index = current.bm25_index.copy()
+            first_vector_id = self.vectorstore.ntotal
+
+            if children:
+                texts = [child.page_content for child in children]
+                self.vector_db_client.add_embeddings(texts, vectors, [child.metadata for child in children])
+            self.docstore.mset(parents)
+            self.vector_db_client.save()
+
+            source_vector_ids = {source: list(ids) for source, ids in current.source_vector_ids.items()}
+            self._map_vector_ids(self.vectorstore, range(first_vector_id, self.vectorstore.ntotal), source_vector_ids)
+
+            # Only the new pages are written; earlier segments are never rewritten
+            positions = self.store.append(documents, tokens=page_tokens)
+            self.store.save_meta(version=current.version + 1)
+
+            bm25_index.add_documents(documents, ids=positions)
+
+            self._snapshot = self._make_snapshot(source_vector_ids, bm25_index)
+
+    def export_source(self, source: str) -> Tuple[List[Document], List[Document], List[Tuple[str, Document]], List[List[float]], List[int]]:
+        """
+        A source's pages, child chunks, (parent id, page) pairs, child vectors and page token counts,
+        in the order `index_chunks` takes them, so another partition can index it without re-embedding.
+        """
+        snapshot = self._snapshot
+        vectorstore = snapshot.vectorstore
+        id_key = self.parent_retriever.id_key
+        children, vector_ids = [], []
+        for vector_id in snapshot.source_vector_ids.get(source, []):
+            child = vectorstore.child(vector_id)
+            if isinstance(child, Document):
+                children.append(child)
+                vector_ids.append(vector_id)
+        vectors = self.vector_db_client.reconstruct(vector_ids, vectorstore).tolist() if vector_ids else []
+        parent_ids = list(dict.fromkeys(child.metadata[id_key] for child in children if id_key in child.metadata))
+        parents = [(parent_id, doc) for parent_id, doc in zip(parent_ids, self.docstore.mget(parent_ids)) if doc is not None]
+        positions = sorted(snapshot.sources.get(source, []))
+        documents = self.store.get_many(positions)
+        return documents, children, parents, vectors, [self.store.page_tokens(p) for p in positions]
+
+    def delete_source(self, source: str) -> bool:
+        """Remove a source from every index of the partition. Returns False if it was not ingested."""
+        with self._write_lock:
+            current = self._snapshot
+            vector_ids = current.source_vector_ids.get(source, [])
+            if not vector_ids and source not in current.sources:
+                return False
+            # Taken before the store drops the pages, which a background build in flight may still read
+            bm25_index = current.bm25_index.copy()
+
+            vectorstore = self.vectorstore
+            parent_ids = set()
+            for vector_id in vector_ids:
+                child = vectorstore.child(vector_id)
+                if isinstance(child, Document) and self.parent_retriever.id_key in child.metadata:
+                    parent_ids.add(child.metadata[self.parent_retriever.id_key])
+
+            source_vector_ids = current.source_vector_ids
+            if vector_ids:
+                self.vector_db_client.delete(vector_ids)
+                self.vector_db_client.save()
+                # Remaining vectors were renumbered
+                source_vector_ids = {}
+                self._map_vector_ids(self.vectorstore, range(self.vectorstore.ntotal), source_vector_ids)
+
+            positions = self.store.delete_source(source)
+            self.store.save_meta(version=current.version + 1)
+
+            bm25_index.remove_documents(positions)
+
+            self._snapshot = self._make_snapshot(source_vector_ids, bm25_index)
+            # Queries still holding the previous snapshot may look these parents up and skip them
+            self.docstore.mdelete(list(parent_ids))
+        print(f"Deleted {len(positions)} pages of {source} from notebook {self.notebook_id}")
+        return True
+
+    def list_sources(self) -> List[str]:
+        return self._snapshot.list_sources()
+
+    def resolve_sources(self, file_filters: List[str]) -> List[str]:
+        return self._snapshot.resolve_sources(file_filters)
+
+    def source_positions(self, sources: List[str]) -> List[int]:
+        return self._snapshot.source_positions(sources)
+
+    def source_tokens(self, sources: List[str]) -> int:
+        return self._snapshot.source_tokens(sources)
+
+    def retrieve(self, query: str, file_filters: Optional[List[str]] = None, query_embedding: Optional[List[float]] = None) -> List[Document]:
+        return self._snapshot.retrieve(query, file_filters, query_embedding)
+
+    def memory_usage(self) -> int:
+        """Rough resident size in bytes: raw vectors plus page text held by docstores and BM25."""
+        vector_bytes = self.vectorstore.ntotal * self.vector_db_client.embedding_size * 4
+        # Page text is held by the child chunks of the FAISS docstore and by BM25 postings
+        return vector_bytes + 2 * self.store.data_bytes
+
+
+class PartitionManager:
+    """
+    Lazily loads notebook partitions and evicts the least recently used ones
+    once the estimated resident size exceeds the memory budget.
+    Loading happens outside the manager lock, so a slow load only delays requests for that notebook;
+    concurrent requests for it wait on the same in-flight load. Pinned partitions (being written to)
+    are never evicted, so a writer and a reloaded copy cannot both write the same directory.
+    """
+
+    def __init__(self, loader: Callable[[str], NotebookPartition], memory_budget_bytes: int):
+        self.loader = loader
+        self.memory_budget_bytes = memory_budget_bytes
+        self._partitions: "OrderedDict[str, NotebookPartition]" = OrderedDict()
+        self._sizes = {}
+        self._loading: Dict[str, Future] = {}
+        self._pins: Dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    def get(self, notebook_id: str) -> NotebookPartition:
+        with self._lock:
+            partition = self._partitions.get(notebook_id)
+            if partition is not None:
+                self._partitions.move_to_end(notebook_id)
+                return partition
+            future = self._loading.get(notebook_id)
+            loading = future is None
+            if loading:
+                future = self._loading[notebook_id] = Future()
+        if not loading:
+            return future.result()
+
+        print(f"Loading partition for notebook {notebook_id}")
+        try:
+            partition = self.loader(notebook_id)
+            size = partition.memory_usage()
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(notebook_id, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._loading.pop(notebook_id, None)
+            self._partitions[notebook_id] = partition
+            self._sizes[notebook_id] = size
+            self._evict(keep=notebook_id)
+        future.set_result(partition)
+        return partition
+
+    @contextmanager
+    def pinned(self, notebook_id: str) -> Iterator[NotebookPartition]:
+        """The partition, kept loaded until the block exits. Wrap every write in this."""
+        with self._lock:
+            self._pins[notebook_id] = self._pins.get(notebook_id, 0) + 1
+        try:
+            yield self.get(notebook_id)
+        finally:
+            with self._lock:
+                self._pins[notebook_id] -= 1
+                if not self._pins[notebook_id]:
+                    del self._pins[notebook_id]
+                # Evictions skipped while it was pinned
+                self._evict(keep=notebook_id)
+
+    def refresh(self, notebook_id: str):
+        """Recompute the size of a partition after it has grown and rebalance the cache."""
+        with self._lock:
+            partition = self._partitions.get(notebook_id)
+            if partition is None:
+                return
+            self._sizes[notebook_id] = partition.memory_usage()
+            self._evict(keep=notebook_id)
+
+    def evict(self, notebook_id: str) -> bool:
+        """Drop a partition from memory. Returns False if it is pinned by a writer."""
+        with self._lock:
+            if notebook_id in self._pins:
+                return False
+            self._partitions.pop(notebook_id, None)
+            self._sizes.pop(notebook_id, None)
+            return True
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._partitions)
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def _evict(self, keep: Optional[str] = None):
+        while sum(self._sizes.values()) > self.memory_budget_bytes:
+            victim = next((nid for nid in self._partitions if nid != keep and nid not in self._pins), None)
+            if victim is None:
+                break
+            print(f"Evicting partition for notebook {victim}")
+            self._partitions.pop(victim)
+            self._sizes.pop(victim)
@@ -17,8 +17,6 @@ def main():
     if not os.environ.get("LLAMA_PARSE_API_KEY"):
         print("Warning: LLAMA_PARSE_API_KEY not found. Parsing might fail.")
 
-    is_ingesting = False
-    
     while True:
         print("\nCommands:")
         print("  ingest <path1> [path2] [path3] ... - Add one or more documents")
@@ -50,17 +48,13 @@ def main():
                 print("No valid files to ingest.")
                 continue
             
-            is_ingesting = True
             print(f"\nIngesting {len(valid_paths)} file(s)...")
-            print("Please wait, queries are blocked until ingestion completes.")
             
             try:
                 rag.ingest(valid_paths)
                 print(f"Successfully ingested {len(valid_paths)} file(s).")
             except Exception as e:
                 print(f"Error during ingestion: {e}")
-            finally:
-                is_ingesting = False
                 
         elif command == "list":
             files = rag.list_ingested_files()
@@ -72,18 +66,11 @@ def main():
                 print("No files ingested yet.")
                 
         elif command.startswith("debug "):
-            if is_ingesting:
-                print("Error: Ingestion in progress. Please wait until it completes.")
-                continue
-                
             query_text = command[6:].strip()
             rag.debug_retrieval(query_text)
                 
         elif command.startswith("query "):
-            if is_ingesting:
-                print("Error: Ingestion in progress. Please wait until it completes.")
-                continue
-                
+            # Queries read an immutable index snapshot, so they never see a half-finished ingest
             if "--files " in command:
                 parts = command.split("--files ", 1)
                 after_flag = parts[1]
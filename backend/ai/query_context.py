@@ -0,0 +1,23 @@
+from typing import Callable, List, Optional
+
+
+class QueryContext:
+    """
+    Per-request state of one query: the query embedding, the intent and the classifier probabilities.
+    It is created once by RAGSystem.prepare_query and passed through routing, caching and retrieval,
+    so the query is embedded at most once and classified exactly once.
+    """
+
+    def __init__(self, query: str, embed_query: Callable[[str], List[float]]):
+        self.query = query
+        self.intent: Optional[str] = None
+        self.probabilities: Optional[List[float]] = None
+        self._embed_query = embed_query
+        self._embedding: Optional[List[float]] = None
+
+    @property
+    def embedding(self) -> List[float]:
+        # Chit-chat never needs the embedding, so it is computed on first use
+        if self._embedding is None:
+            self._embedding = self._embed_query(self.query)
+        return self._embedding
@@ -1,20 +1,30 @@
 import os
+import asyncio
+import json
+import pickle
+import threading
+import time
 import warnings
-from typing import List, Any
+from concurrent.futures import Future
+from typing import List, Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+from langchain.schema import Document
 from langchain_google_genai import ChatGoogleGenerativeAI
+from google import genai
+from google.genai import types as genai_types
 from langchain_community.vectorstores import FAISS
 from langchain_community.docstore.in_memory import InMemoryDocstore
 import faiss
+import numpy as np
 warnings.filterwarnings("ignore", message="Convert_system_message_to_human will be deprecated!")
 
 import joblib
-from sentence_transformers import SentenceTransformer
+from ai.registry import get_sentence_transformer
 
 class IntentClassifier:
-    def __init__(self):
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', device: str = "cpu"):
         self.chit_chat_keywords = {kw.lower() for kw in ["hi", "hello", "hola", "hey", "hi there", "hello there", "hey there"]}
         self.ml_model_path = "intent_router.pkl"
-        self.encoder = SentenceTransformer('all-MiniLM-L6-v2')
+        self.encoder = get_sentence_transformer(model_name, device)
         
         if os.path.exists(self.ml_model_path):
             self.classifier = joblib.load(self.ml_model_path)
@@ -22,39 +32,103 @@ class IntentClassifier:
             print(f"Warning: {self.ml_model_path} not found. ML classification disabled.")
             self.classifier = None
 
-    def predict(self, query: str) -> str:
+    def is_chit_chat(self, query: str) -> bool:
+        cleaned_query = query.strip().lower()
+        cleaned_no_punct = cleaned_query.rstrip("!?.")
+        return cleaned_query in self.chit_chat_keywords or cleaned_no_punct in self.chit_chat_keywords
+
+    def predict(self, query: str, query_embedding: Any = None) -> str:
         """
         Predicts the intent of the query.
         Returns: "Hardcoded_Chat", "ML_Chat", or "Retrieval"
         """
-        cleaned_query = query.strip().lower()
-        cleaned_no_punct = cleaned_query.rstrip("!?.")
-        
-        if cleaned_query in self.chit_chat_keywords or cleaned_no_punct in self.chit_chat_keywords:
-            return "Hardcoded_Chat"
+        return self.classify(query, query_embedding)[0]
+
+    def classify(self, query: str, query_embedding: Any = None) -> Tuple[str, Optional[List[float]]]:
+        """
+        Returns the intent and the classifier probabilities (None when the ML model was not used).
+        `query_embedding` must come from the same model as `self.encoder`; without it the query is encoded here.
+        """
+        if self.is_chit_chat(query):
+            return "Hardcoded_Chat", None
 
         if self.classifier:
             try:
-                query_embedding = self.encoder.encode([query])
+                if query_embedding is None:
+                    query_embedding = self.encoder.encode([query])
+                else:
+                    query_embedding = np.asarray([query_embedding], dtype="float32")
                 prediction = self.classifier.predict(query_embedding)[0]
                 prob = self.classifier.predict_proba(query_embedding)[0]
+                probabilities = [float(p) for p in prob]
                 if max(prob) < 0.7:
-                    return "Retrieval"
+                    return "Retrieval", probabilities
                 
                 ml_intent = "Retrieval" if prediction == 1 else "Chat"
                 
                 if ml_intent == "Chat":
-                    return "ML_Chat"
+                    return "ML_Chat", probabilities
                 else:
-                    return "Retrieval"
+                    return "Retrieval", probabilities
             except Exception as e:
                 print(f"Error in ML classification: {e}")
-                return "Retrieval"
+                return "Retrieval", None
         
-        return "Retrieval"
+        return "Retrieval", None
+
+class GeminiContextCacheProvider:
+    """
+    Gemini explicit context caching.
+    A large context prefix is uploaded once and later requests only send the question plus the cache name.
+    """
+
+    def __init__(self, model_name: str, api_key: str, ttl_seconds: int = 3600):
+        self.model_name = model_name
+        self.ttl_seconds = ttl_seconds
+        self.client = genai.Client(api_key=api_key)
+
+    def create(self, system_instruction: str, context: str) -> str:
+        cache = self.client.caches.create(
+            model=self.model_name,
+            config=genai_types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                contents=[context],
+                ttl=f"{self.ttl_seconds}s",
+            ),
+        )
+        return cache.name
+
+    def generate(self, cache_name: str, question: str) -> str:
+        response = self.client.models.generate_content(
+            model=self.model_name,
+            contents=question,
+            config=genai_types.GenerateContentConfig(cached_content=cache_name),
+        )
+        return response.text
+
+    async def agenerate(self, cache_name: str, question: str) -> str:
+        response = await self.client.aio.models.generate_content(
+            model=self.model_name,
+            contents=question,
+            config=genai_types.GenerateContentConfig(cached_content=cache_name),
+        )
+        return response.text
+
+    async def agenerate_stream(self, cache_name: str, question: str) -> AsyncIterator[str]:
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.model_name,
+            contents=question,
+            config=genai_types.GenerateContentConfig(cached_content=cache_name),
+        )
+        async for response in stream:
+            if response.text:
+                yield response.text
+
+    def delete(self, cache_name: str):
+        self.client.caches.delete(name=cache_name)
 
 class LLMClient:
-    def __init__(self, model_name: str, api_key_env: str):
+    def __init__(self, model_name: str, api_key_env: str, context_cache_provider: Any = None):
         self.model_name = model_name
         self.api_key = os.environ.get(api_key_env)
         if not self.api_key:
@@ -66,40 +140,459 @@ class LLMClient:
             convert_system_message_to_human=True
         )
 
+        # Any object with create/generate/delete (see GeminiContextCacheProvider); None disables provider caching
+        self.context_cache_provider = context_cache_provider
+        self._cached_contexts = {} # cache key -> (provider cache name, expires_at)
+        self._uploads: Dict[Tuple, Future] = {} # cache key -> in-flight upload
+        self._cache_lock = threading.Lock()
+
     def invoke(self, prompt: str) -> Any:
         return self.llm.invoke(prompt)
 
+    async def ainvoke(self, prompt: str) -> Any:
+        return await self.llm.ainvoke(prompt)
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        async for chunk in self.llm.astream(prompt):
+            if chunk.content:
+                yield chunk.content
+
+    def _cached_context_name(self, cache_key: Tuple, system_instruction: str, context: str) -> str:
+        """
+        Provider cache name for `cache_key`; the prefix is uploaded on first use and again after it expires.
+        The upload runs outside the lock, so other keys are not blocked meanwhile; concurrent callers for
+        the same key wait for the single in-flight upload.
+        """
+        now = time.time()
+        with self._cache_lock:
+            entry = self._cached_contexts.get(cache_key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+            upload = self._uploads.get(cache_key)
+            uploading = upload is None
+            if uploading:
+                upload = self._uploads[cache_key] = Future()
+        if not uploading:
+            return upload.result()
+
+        try:
+            name = self.context_cache_provider.create(system_instruction, context)
+        except BaseException as e:
+            with self._cache_lock:
+                self._uploads.pop(cache_key, None)
+            upload.set_exception(e)
+            raise
+        with self._cache_lock:
+            self._uploads.pop(cache_key, None)
+            # Re-upload slightly before the provider expires the cache
+            self._cached_contexts[cache_key] = (name, now + self.context_cache_provider.ttl_seconds - 60)
+        upload.set_result(name)
+        return name
+
+    def invoke_with_cached_context(self, cache_key: Tuple, system_instruction: str, context: str, question: str) -> str:
+        """
+        Answer `question` against a context prefix stored in the provider cache under `cache_key`.
+        Raises if the provider call fails.
+        """
+        name = self._cached_context_name(cache_key, system_instruction, context)
+        try:
+            return self.context_cache_provider.generate(name, question)
+        except Exception:
+            with self._cache_lock:
+                self._cached_contexts.pop(cache_key, None)
+            raise
+
+    async def ainvoke_with_cached_context(self, cache_key: Tuple, system_instruction: str, context: str, question: str) -> str:
+        # Uploads are rare and go through the blocking client, off the event loop
+        name = await asyncio.to_thread(self._cached_context_name, cache_key, system_instruction, context)
+        try:
+            return await self.context_cache_provider.agenerate(name, question)
+        except Exception:
+            with self._cache_lock:
+                self._cached_contexts.pop(cache_key, None)
+            raise
+
+    async def astream_with_cached_context(self, cache_key: Tuple, system_instruction: str, context: str, question: str) -> AsyncIterator[str]:
+        name = await asyncio.to_thread(self._cached_context_name, cache_key, system_instruction, context)
+        try:
+            async for text in self.context_cache_provider.agenerate_stream(name, question):
+                yield text
+        except Exception:
+            with self._cache_lock:
+                self._cached_contexts.pop(cache_key, None)
+            raise
+
+    def drop_cached_contexts(self, notebook_id: str):
+        """Delete provider caches built from a notebook's previous corpus."""
+        with self._cache_lock:
+            keys = [key for key in self._cached_contexts if key[0] == notebook_id]
+            entries = [self._cached_contexts.pop(key) for key in keys]
+        for name, _ in entries:
+            try:
+                self.context_cache_provider.delete(name)
+            except Exception as e:
+                print(f"Error deleting context cache {name}: {e}")
+
+class VectorSegments:
+    """
+    Published, immutable state of a VectorDBClient.
+    `base` is a LangChain FAISS store (index, docstore, id mapping) shared by every snapshot until the
+    next merge or delete. Recent additions live in a small delta of raw vectors and their child
+    documents, searched exactly. Vector ids run through the base first, then the delta.
+    `generation` changes whenever the base does.
+    """
+
+    def __init__(self, base: Any, delta_vectors: np.ndarray, delta_children: List[Document], generation: int):
+        self.base = base
+        self.delta_vectors = delta_vectors
+        self.delta_children = delta_children
+        self.generation = generation
+
+    @property
+    def base_ntotal(self) -> int:
+        return self.base.index.ntotal
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.index.ntotal + len(self.delta_children)
+
+    def child(self, vector_id: int) -> Any:
+        """Child document of a vector id (what the docstore holds, normally a Document)."""
+        base_ntotal = self.base_ntotal
+        if vector_id < base_ntotal:
+            return self.base.docstore.search(self.base.index_to_docstore_id[vector_id])
+        return self.delta_children[vector_id - base_ntotal]
+
+    def children(self) -> Iterator[Any]:
+        for vector_id in range(self.ntotal):
+            yield self.child(vector_id)
+
+    def reconstruct(self, ids: np.ndarray) -> np.ndarray:
+        base_ntotal = self.base_ntotal
+        in_base = ids < base_ntotal
+        vectors = np.empty((len(ids), self.delta_vectors.shape[1]), dtype="float32")
+        if in_base.any():
+            vectors[in_base] = self.base.index.reconstruct_batch(ids[in_base])
+        if not in_base.all():
+            vectors[~in_base] = self.delta_vectors[ids[~in_base] - base_ntotal]
+        return vectors
+
+
 class VectorDBClient:
-    def __init__(self, index_path: str, embedding_function: Any, embedding_size: int = 384):
+    """
+    FAISS vector store whose index type is chosen in config.yaml (vector_index section):
+    "flat" (exact), "hnsw", "ivf_flat" or "ivf_pq".
+    IVF indexes need training, so they start as flat and are trained once enough vectors exist.
+    An existing index of another type is migrated on load by reconstructing its vectors.
+
+    The published `vectorstore` (VectorSegments) is never modified. Additions go to a small delta
+    that is copied on each write, and are merged into a clone of the base index once the delta
+    exceeds `delta_merge_ratio` of the base (bounded by `delta_min_vectors` and `delta_max_vectors`).
+    Deletes rebuild the base. So a write costs O(delta) except at merges and deletes, and searches
+    holding a previous state are unaffected.
+    The base is saved under its generation only when it changes; saves in between rewrite the delta.
+    """
+
+    def __init__(self, index_path: str, embedding_function: Any, embedding_size: int = 384, index_config: dict = None):
         self.index_path = index_path
         self.embeddings = embedding_function
         self.embedding_size = embedding_size
-        self.vectorstore = self._load_or_create()
 
-    def _load_or_create(self):
-        if os.path.exists(self.index_path):
-            return FAISS.load_local(
-                self.index_path, 
+        index_config = index_config or {}
+        self.index_type = index_config.get("type", "flat")
+        self.hnsw_m = index_config.get("hnsw_m", 32)
+        self.ef_construction = index_config.get("ef_construction", 200)
+        self.ef_search = index_config.get("ef_search", 64)
+        self.nlist = index_config.get("nlist", 1024)
+        self.nprobe = index_config.get("nprobe", 16)
+        self.pq_m = index_config.get("pq_m", 48)
+        self.pq_nbits = index_config.get("pq_nbits", 8)
+        # Filtered searches over at most this many vectors compare them all instead of using the index
+        self.exact_search_max_ids = index_config.get("exact_search_max_ids", 20000)
+        self.delta_merge_ratio = index_config.get("delta_merge_ratio", 0.1)
+        self.delta_min_vectors = index_config.get("delta_min_vectors", 2048)
+        self.delta_max_vectors = index_config.get("delta_max_vectors", 50000)
+        # FAISS wants ~39 training points per centroid
+        default_train_size = 39 * max(self.nlist, 2 ** self.pq_nbits if self.index_type == "ivf_pq" else 0)
+        self.min_train_size = index_config.get("min_train_size", default_train_size)
+
+        # Generation of the base last written to disk, None when it never was
+        self._saved_generation = None
+        segments = self._load_or_create()
+        base_index = segments.base.index
+        segments.base.index = self._migrated(base_index)
+        if segments.base.index is not base_index and base_index.ntotal:
+            segments.generation += 1
+        self.vectorstore = segments
+        if self._saved_generation is not None and self._saved_generation != segments.generation:
+            # Persist the migrated index, so the next start does not rebuild it again
+            self.save()
+
+    def _base_name(self, generation: int) -> str:
+        # Generation 0 keeps the file names of indexes written before segments existed
+        return "index" if generation == 0 else f"index-{generation}"
+
+    def _segments_path(self) -> str:
+        return os.path.join(self.index_path, "segments.json")
+
+    def _delta_path(self, generation: int) -> str:
+        return os.path.join(self.index_path, f"delta-{generation}.pkl")
+
+    def _load_or_create(self) -> VectorSegments:
+        generation = 0
+        if os.path.exists(self._segments_path()):
+            with open(self._segments_path(), "r") as f:
+                generation = json.load(f)["generation"]
+
+        name = self._base_name(generation)
+        if os.path.exists(os.path.join(self.index_path, f"{name}.faiss")):
+            base = FAISS.load_local(
+                self.index_path,
                 self.embeddings,
+                index_name=name,
                 allow_dangerous_deserialization=True
             )
+            self._saved_generation = generation
+        else:
+            base = self._empty_store(faiss.IndexFlatL2(self.embedding_size))
+
+        delta_vectors = np.zeros((0, self.embedding_size), dtype="float32")
+        delta_children = []
+        if os.path.exists(self._delta_path(generation)):
+            with open(self._delta_path(generation), "rb") as f:
+                delta = pickle.load(f)
+            delta_vectors, delta_children = delta["vectors"], delta["children"]
+        return VectorSegments(base, delta_vectors, delta_children, generation)
+
+    def _empty_store(self, index) -> Any:
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={}
+        )
+
+    @staticmethod
+    def _index_type(index) -> str:
+        if isinstance(index, faiss.IndexHNSWFlat):
+            return "hnsw"
+        if isinstance(index, faiss.IndexIVFPQ):
+            return "ivf_pq"
+        if isinstance(index, faiss.IndexIVFFlat):
+            return "ivf_flat"
+        return "flat"
+
+    def _build_index(self, vectors):
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(self.embedding_size, self.hnsw_m)
+            index.hnsw.efConstruction = self.ef_construction
+        elif self.index_type in ("ivf_flat", "ivf_pq"):
+            quantizer = faiss.IndexFlatL2(self.embedding_size)
+            if self.index_type == "ivf_flat":
+                index = faiss.IndexIVFFlat(quantizer, self.embedding_size, self.nlist)
+            else:
+                index = faiss.IndexIVFPQ(quantizer, self.embedding_size, self.nlist, self.pq_m, self.pq_nbits)
+            index.train(vectors)
         else:
             index = faiss.IndexFlatL2(self.embedding_size)
-            return FAISS(
-                embedding_function=self.embeddings,
-                index=index,
-                docstore=InMemoryDocstore(),
-                index_to_docstore_id={}
+        index.add(vectors)
+        return index
+
+    @staticmethod
+    def _reconstruct_all(index):
+        # make_direct_map changes the index, so this is only called on unpublished indexes
+        if isinstance(index, faiss.IndexIVF):
+            index.make_direct_map()
+        return index.reconstruct_n(0, index.ntotal)
+
+    def _migrated(self, index):
+        """The index rebuilt as the configured type, keeping vector ids (and their docstore mapping) in order."""
+        current = self._index_type(index)
+        ntotal = index.ntotal
+        if current != self.index_type:
+            needs_training = self.index_type in ("ivf_flat", "ivf_pq")
+            # Untrained IVF types keep searching the current index until there is enough data to train on
+            if not needs_training or ntotal >= max(self.min_train_size, 1):
+                if ntotal:
+                    print(f"Migrating FAISS index at {self.index_path} from {current} to {self.index_type} ({ntotal} vectors)")
+                    vectors = self._reconstruct_all(index)
+                else:
+                    vectors = np.zeros((0, self.embedding_size), dtype="float32")
+                index = self._build_index(vectors)
+        self._apply_search_params(index)
+        return index
+
+    def _apply_search_params(self, index):
+        if isinstance(index, faiss.IndexHNSWFlat):
+            index.hnsw.efSearch = self.ef_search
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = self.nprobe
+            # Filtered searches reconstruct vectors by id; the map is kept up to date by later adds
+            if index.direct_map.type == faiss.DirectMap.NoMap:
+                index.make_direct_map()
+
+    def _copy_base(self, segments: VectorSegments):
+        """Private copy of the base store for a merge or delete to modify."""
+        base = segments.base
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=faiss.clone_index(base.index),
+            docstore=InMemoryDocstore(dict(base.docstore._dict)),
+            index_to_docstore_id=dict(base.index_to_docstore_id)
+        )
+
+    def _merge(self, segments: VectorSegments) -> VectorSegments:
+        """Fold the delta into a clone of the base; vector ids do not change."""
+        base = self._copy_base(segments)
+        if segments.delta_children:
+            base.add_embeddings(
+                [(child.page_content, vector) for child, vector in zip(segments.delta_children, segments.delta_vectors)],
+                metadatas=[child.metadata for child in segments.delta_children]
             )
+        # Train IVF indexes as soon as the corpus is large enough, before readers can see the new base
+        base.index = self._migrated(base.index)
+        empty = np.zeros((0, self.embedding_size), dtype="float32")
+        return VectorSegments(base, empty, [], segments.generation + 1)
+
+    def _delta_limit(self, base_ntotal: int) -> int:
+        return min(self.delta_max_vectors, max(self.delta_min_vectors, int(self.delta_merge_ratio * base_ntotal)))
+
+    def add_embeddings(self, texts: List[str], embeddings: List[List[float]], metadatas: List[dict]):
+        current = self.vectorstore
+        children = [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
+        segments = VectorSegments(
+            current.base,
+            np.concatenate([current.delta_vectors, np.asarray(embeddings, dtype="float32").reshape(-1, self.embedding_size)]),
+            current.delta_children + children,
+            current.generation,
+        )
+        if len(segments.delta_children) > self._delta_limit(segments.base_ntotal):
+            segments = self._merge(segments)
+        self.vectorstore = segments
 
-    def add_documents(self, documents: List[Any]):
-        self.vectorstore.add_documents(documents)
+    def delete(self, vector_ids: List[int]):
+        """
+        Remove vectors and their child documents. The delta is folded into a clone of the base (keeping
+        any IVF training), which is refilled with the remaining vectors, so ids stay contiguous for every index type.
+        """
+        removed = set(vector_ids)
+        merged = self._merge(self.vectorstore)
+        base = merged.base
+        index = base.index
+        keep = [i for i in range(index.ntotal) if i not in removed]
+        vectors = self._reconstruct_all(index)[keep]
+        index.reset()
+        index.add(vectors)
+
+        old_mapping = base.index_to_docstore_id
+        base.docstore.delete([old_mapping[i] for i in removed])
+        base.index_to_docstore_id = {new: old_mapping[old] for new, old in enumerate(keep)}
+        self.vectorstore = merged
 
     def save(self):
-        self.vectorstore.save_local(self.index_path)
+        """Write the base if it changed since the last save, then the delta and the segment file."""
+        segments = self.vectorstore
+        os.makedirs(self.index_path, exist_ok=True)
+        if segments.generation != self._saved_generation:
+            segments.base.save_local(self.index_path, index_name=self._base_name(segments.generation))
+
+        delta_path = self._delta_path(segments.generation)
+        tmp_path = f"{delta_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"vectors": segments.delta_vectors, "children": segments.delta_children}, f)
+        os.replace(tmp_path, delta_path)
+
+        tmp_path = f"{self._segments_path()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"generation": segments.generation}, f)
+        os.replace(tmp_path, self._segments_path())
+
+        if segments.generation != self._saved_generation:
+            # Files of earlier generations are unreachable once the segment file points past them
+            current = {f"{self._base_name(segments.generation)}.faiss", f"{self._base_name(segments.generation)}.pkl", os.path.basename(delta_path)}
+            for name in os.listdir(self.index_path):
+                if name not in current and (name.startswith("index") or name.startswith("delta-")) and name.endswith((".faiss", ".pkl")):
+                    os.remove(os.path.join(self.index_path, name))
+            self._saved_generation = segments.generation
+
+    def search_by_vector(self, embedding: List[float], k: int, ids: Optional[List[int]] = None, vectorstore: Any = None) -> List[Tuple[Any, float]]:
+        """
+        Return (child document, L2 distance) pairs from the base index and the delta.
+        When `ids` is given only those vector ids are considered. Up to `exact_search_max_ids` of them
+        are reconstructed and compared exactly; larger sets search the base index through an ID selector
+        with efSearch/nprobe raised by ntotal / len(ids), as the graph or the probed lists mostly hold
+        vectors outside the filter, and fall back to the exact comparison if fewer than k hits come back.
+        The delta is always compared exactly.
+        `vectorstore` searches a previously published state (an index snapshot) instead of the current one.
+        """
+        segments = vectorstore if vectorstore is not None else self.vectorstore
+        if segments.ntotal == 0:
+            return []
+
+        query = np.asarray([embedding], dtype="float32")
+        base_ntotal = segments.base_ntotal
+        if ids is None:
+            base_ids = None
+            delta_ids = np.arange(base_ntotal, segments.ntotal, dtype="int64")
+        else:
+            if not ids:
+                return []
+            ids = np.asarray(ids, dtype="int64")
+            k = min(k, len(ids))
+            base_ids, delta_ids = ids[ids < base_ntotal], ids[ids >= base_ntotal]
+
+        results = self._search_base(segments, query, k, base_ids)
+        if len(delta_ids):
+            results += self._exact_search(segments, query, min(k, len(delta_ids)), delta_ids)
+        results.sort(key=lambda hit: hit[1])
+        return results[:k]
+
+    def _search_base(self, segments: VectorSegments, query: np.ndarray, k: int, ids: Optional[np.ndarray]) -> List[Tuple[Any, float]]:
+        index = segments.base.index
+        if index.ntotal == 0:
+            return []
+        if ids is None:
+            distances, labels = index.search(query, min(k, index.ntotal))
+            return self._hits(segments, distances[0], labels[0])
+
+        if not len(ids):
+            return []
+        k = min(k, len(ids))
+        if len(ids) <= self.exact_search_max_ids:
+            return self._exact_search(segments, query, k, ids)
+
+        selector = faiss.IDSelectorBatch(ids)
+        # Expected share of visited vectors that pass the filter
+        boost = index.ntotal / len(ids)
+        if isinstance(index, faiss.IndexHNSWFlat):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(int(self.ef_search * boost), k))
+        elif isinstance(index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=min(int(self.nprobe * boost), index.nlist))
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        distances, labels = index.search(query, k, params=params)
+        results = self._hits(segments, distances[0], labels[0])
+        if len(results) < k:
+            return self._exact_search(segments, query, k, ids)
+        return results
+
+    def reconstruct(self, ids: List[int], vectorstore: Any = None) -> np.ndarray:
+        """Stored vectors of the given ids (decoded approximations for PQ indexes)."""
+        segments = vectorstore if vectorstore is not None else self.vectorstore
+        return segments.reconstruct(np.asarray(ids, dtype="int64"))
+
+    def _exact_search(self, segments: VectorSegments, query: np.ndarray, k: int, ids: np.ndarray) -> List[Tuple[Any, float]]:
+        """Brute-force L2 over the given vector ids only."""
+        vectors = segments.reconstruct(ids)
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        top = np.argpartition(distances, k - 1)[:k] if k < len(ids) else np.arange(len(ids))
+        top = top[np.argsort(distances[top], kind="stable")]
+        return self._hits(segments, distances[top], ids[top])
 
-    def similarity_search_with_score(self, query: str, k: int = 5):
-        return self.vectorstore.similarity_search_with_score(query, k=k)
-    
-    def as_retriever(self):
-        return self.vectorstore
+    @staticmethod
+    def _hits(segments: VectorSegments, distances, labels) -> List[Tuple[Any, float]]:
+        return [
+            (segments.child(int(label)), float(distance))
+            for distance, label in zip(distances, labels)
+            if label != -1
+        ]
@@ -1,21 +1,56 @@
 import os
+import asyncio
 import yaml
 import json
-import pickle
+import threading
+import time
 import warnings
-from typing import List, Dict, Any, Tuple
-from dataclasses import dataclass
+from typing import List, Dict, Any, AsyncIterator, Callable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.storage import InMemoryStore
-from langchain.retrievers import ParentDocumentRetriever
 
 import ai.parser as parser
-from ai.rag_modules import IntentClassifier, LLMClient, VectorDBClient
+from ai.rag_modules import IntentClassifier, LLMClient, GeminiContextCacheProvider
+from ai.context_cache import ContextCache
+from ai.context_packer import ContextPacker
+from ai.answer_cache import SemanticAnswerCache
+from ai.parse_cache import ParseCache
+from ai.ingest_pipeline import PipelineStage, StagedPipeline
+from ai.embeddings import BatchedEmbeddings, CachedEmbeddings
+from ai.partition import DEFAULT_PARTITION, NotebookPartition, PartitionManager, PartitionSnapshot
+from ai.query_context import QueryContext
+from ai.token_counter import configure as configure_token_counter
+from ai.text_analyzer import Analyzer
+from ai.hybrid_retriever import HybridRetriever
+
+# Context window of the Gemini model, in tokens
+MAX_WINDOW = 1000000
+
+NO_DOCUMENTS_MESSAGE = "Error: No documents indexed."
+NO_RELEVANT_DOCUMENTS_MESSAGE = "No relevant documents found in the selected files."
+
+FULL_CONTEXT_INSTRUCTION = (
+    "You are a helpful assistant. Answer the user's question based on the following context.\n"
+    "Always cite your sources using the format [Source: filename, Page: number]."
+)
+
+@dataclass
+class PreparedAnswer:
+    """
+    Result of the steps before the LLM call. `answer` is set when no LLM call is needed
+    (chit-chat, answer cache hit, no documents); otherwise `prompt` is sent, or `cached_context`
+    (arguments of LLMClient.invoke_with_cached_context) is tried first.
+    """
+    intent: Optional[str] = None
+    mode: Optional[str] = None
+    answer: Optional[str] = None
+    prompt: Optional[str] = None
+    cached_context: Optional[Tuple] = None
+    answer_key: Optional[Tuple] = None
+    citations: List[Dict[str, Any]] = field(default_factory=list)  # {"source", "page"} of the context pages
 
 @dataclass
 class Config:
@@ -28,11 +63,28 @@ class Config:
     embedding_device: str
     retrieval_k: int
     parsing_api_key_env: str
+    parse_cache_dir: str = None
+    parse_cache_max_mb: int = 1024
+    embedding_cache_path: str = None
+    embedding_batch_size: int = 64
+    embedding_num_workers: int = 0
+    partitions_root: str = "indexes"
+    partitions_memory_budget_mb: int = 1024
+    query_executor_workers: int = 4
+    vector_index: dict = field(default_factory=dict)
+    context_cache: dict = field(default_factory=dict)
+    answer_cache: dict = field(default_factory=dict)
+    ingest: dict = field(default_factory=dict)
+    tokens: dict = field(default_factory=dict)
+    context_packing: dict = field(default_factory=dict)
+    bm25: dict = field(default_factory=dict)
+    retrieval: dict = field(default_factory=dict)
 
     @classmethod
     def load(cls, path: str = "config.yaml"):
         with open(path, "r") as f:
             config_data = yaml.safe_load(f)
+        partitions = config_data.get("partitions", {})
         return cls(
             threshold_ratio=config_data["system"]["threshold_ratio"],
             chunk_size=config_data["system"]["chunk_size"],
@@ -42,92 +94,201 @@ class Config:
             embedding_model_name=config_data["embedding"]["model_name"],
             embedding_device=config_data["embedding"]["device"],
             retrieval_k=config_data["retrieval"]["k"],
-            parsing_api_key_env=config_data["parsing"]["api_key_env"]
+            parsing_api_key_env=config_data["parsing"]["api_key_env"],
+            parse_cache_dir=config_data["parsing"].get("cache_dir"),
+            parse_cache_max_mb=config_data["parsing"].get("cache_max_mb", 1024),
+            embedding_cache_path=config_data["embedding"].get("cache_path"),
+            embedding_batch_size=config_data["embedding"].get("batch_size", 64),
+            embedding_num_workers=config_data["embedding"].get("num_workers", 0),
+            partitions_root=partitions.get("root", "indexes"),
+            partitions_memory_budget_mb=partitions.get("memory_budget_mb", 1024),
+            query_executor_workers=config_data.get("query", {}).get("executor_workers", 4),
+            vector_index=config_data.get("vector_index", {}),
+            context_cache=config_data.get("context_cache", {}),
+            answer_cache=config_data.get("answer_cache", {}),
+            ingest=config_data.get("ingest", {}),
+            tokens=config_data.get("tokens", {}),
+            context_packing=config_data.get("context_packing", {}),
+            bm25=config_data.get("bm25", {}),
+            retrieval=config_data["retrieval"]
         )
 
 class RAGSystem:
     def __init__(self, config_path: str = "config.yaml"):
         self.config = Config.load(config_path)
         self._setup_environment()
-        
-        self.intent_classifier = IntentClassifier()
-        self.llm_client = LLMClient(self.config.llm_model_name, self.config.llm_api_key_env)
-        
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name=self.config.embedding_model_name,
-            model_kwargs={'device': self.config.embedding_device}
+
+        # One counting method for ingest and mode selection; set before any partition store is opened
+        self.token_counter = configure_token_counter(
+            tokenizer_name=self.config.tokens.get("tokenizer"),
+            scale=self.config.tokens.get("scale", 1.0)
         )
         
-        self.index_path = "faiss_index"
-        self.vector_db_client = VectorDBClient(
-            index_path=self.index_path,
-            embedding_function=self.embeddings
+        self.intent_classifier = IntentClassifier(device=self.config.embedding_device)
+
+        # Notebooks below this many tokens are sent whole instead of retrieved from
+        self.full_context_budget = int(MAX_WINDOW * self.config.threshold_ratio)
+        packing_config = self.config.context_packing
+        self.context_packer = ContextPacker(
+            budget_tokens=packing_config.get("rag_budget_tokens", 8000),
+            dedup_threshold=packing_config.get("dedup_threshold", 0.8),
+            mmr_lambda=packing_config.get("mmr_lambda", 0.7),
+            boilerplate_min_pages=packing_config.get("boilerplate_min_pages", 3)
+        )
+
+        # Assembled full-context prompts are reused until the notebook's corpus changes
+        cache_config = self.config.context_cache
+        self.context_cache = ContextCache(max_entries=cache_config.get("max_entries", 32))
+        self.provider_cache_min_tokens = cache_config.get("min_tokens", 4096)
+        context_cache_provider = None
+        llm_api_key = os.environ.get(self.config.llm_api_key_env)
+        if cache_config.get("provider_cache", False) and llm_api_key:
+            context_cache_provider = GeminiContextCacheProvider(
+                self.config.llm_model_name,
+                llm_api_key,
+                ttl_seconds=cache_config.get("ttl_seconds", 3600)
+            )
+        self.llm_client = LLMClient(
+            self.config.llm_model_name,
+            self.config.llm_api_key_env,
+            context_cache_provider=context_cache_provider
         )
-        self.vectorstore = self.vector_db_client.vectorstore
+
+        # Near-duplicate questions on an unchanged corpus reuse the previous answer
+        answer_cache_config = self.config.answer_cache
+        self.answer_cache = None
+        if answer_cache_config.get("enabled", False):
+            self.answer_cache = SemanticAnswerCache(
+                similarity_threshold=answer_cache_config.get("similarity_threshold", 0.95),
+                ttl_seconds=answer_cache_config.get("ttl_seconds", 86400),
+                max_entries=answer_cache_config.get("max_entries", 2048)
+            )
         
-        self.docstore = InMemoryStore() # For Parent Document Retrieval
+        self.embeddings = BatchedEmbeddings(
+            model_name=self.config.embedding_model_name,
+            device=self.config.embedding_device,
+            batch_size=self.config.embedding_batch_size,
+            num_workers=self.config.embedding_num_workers
+        )
+        # The registry hands out one model per name, so when the intent classifier uses the embedding
+        # model, the retrieval embedding of a query doubles as the classifier input
+        self.intent_shares_embedding = self.intent_classifier.encoder is self.embeddings.model
+        if self.config.embedding_cache_path:
+            # Chunks already embedded for any notebook are looked up by content hash instead of re-embedded
+            self.embeddings = CachedEmbeddings(
+                self.embeddings,
+                model_name=self.config.embedding_model_name,
+                path=self.config.embedding_cache_path
+            )
         
         self.child_splitter = RecursiveCharacterTextSplitter(
             chunk_size=self.config.chunk_size,
             chunk_overlap=self.config.chunk_overlap
         )
 
-        self.parent_retriever = ParentDocumentRetriever(
-            vectorstore=self.vectorstore,
-            docstore=self.docstore,
-            child_splitter=self.child_splitter,
-            # parent_splitter=None, # We will feed parent documents directly
+        bm25 = self.config.bm25
+        self.bm25_config = {
+            "k1": bm25.get("k1", 1.5),
+            "b": bm25.get("b", 0.75),
+            "merge_ratio": bm25.get("merge_ratio", 0.1),
+            "analyzer": Analyzer(fold_accents=bm25.get("fold_diacritics", True)),
+        }
+
+        retrieval = self.config.retrieval
+        self.hybrid_retriever = HybridRetriever(
+            weights={"dense": retrieval.get("dense_weight", 0.5), "sparse": retrieval.get("sparse_weight", 0.5)},
+            method=retrieval.get("fusion", "rrf"),
+            rrf_c=retrieval.get("rrf_c", 60),
+            leg_timeout_seconds=retrieval.get("leg_timeout_seconds", 5.0),
+            leg_timeouts=retrieval.get("leg_timeouts"),
+            max_workers=retrieval.get("leg_workers", 8)
         )
-        
-        self.bm25_retriever = None # Initialized after ingestion
-        self.ensemble_retriever = None
-        
-        self.total_tokens = 0
-        self.all_documents = [] 
-        self.docs_path = "documents.pkl"
-        
-        self._load_state()
-        if self.all_documents:
-            self.bm25_retriever = BM25Retriever.from_documents(self.all_documents)
-            self.bm25_retriever.k = self.config.retrieval_k
-            
-            # Initialize Ensemble if we have both
-            self.ensemble_retriever = EnsembleRetriever(
-                retrievers=[self.parent_retriever, self.bm25_retriever],
-                weights=[0.5, 0.5]
+
+        # One FAISS/BM25/docstore partition per notebook, loaded on first use
+        self.partitions = PartitionManager(
+            loader=self._load_partition,
+            memory_budget_bytes=self.config.partitions_memory_budget_mb * 1024 * 1024
+        )
+
+        # LlamaParse results keyed by file content, so re-uploads skip the remote parse
+        self.parse_cache = None
+        if self.config.parse_cache_dir:
+            self.parse_cache = ParseCache(
+                self.config.parse_cache_dir,
+                max_bytes=self.config.parse_cache_max_mb * 1024 * 1024
             )
-        else:
-            self.bm25_retriever = None
-            self.ensemble_retriever = None
 
-    def _save_state(self):
-        state = {
-            "documents": self.all_documents,
-            "total_tokens": self.total_tokens
-        }
-        with open(self.docs_path, "wb") as f:
-            pickle.dump(state, f)
-        print(f"State saved to {self.docs_path}")
+        # CPU stages of aquery() run here, so a burst of queries cannot take every thread of the process
+        self.query_executor = ThreadPoolExecutor(
+            max_workers=self.config.query_executor_workers,
+            thread_name_prefix="rag-query"
+        )
 
-    def _load_state(self):
-        if os.path.exists(self.docs_path):
-            try:
-                with open(self.docs_path, "rb") as f:
-                    state = pickle.load(f)
-                self.all_documents = state.get("documents", [])
-                self.total_tokens = state.get("total_tokens", 0)
-                print(f"Loaded {len(self.all_documents)} documents from {self.docs_path}")
-            except Exception as e:
-                print(f"Error loading state: {e}")
-                self.all_documents = []
-                self.total_tokens = 0
+    def _partition_dir(self, notebook_id: str) -> str:
+        if notebook_id == DEFAULT_PARTITION:
+            # Legacy single-tenant index used by the CLI tools
+            return ""
+        if not notebook_id or os.path.basename(notebook_id) != notebook_id or notebook_id in (".", ".."):
+            raise ValueError(f"Invalid notebook id: {notebook_id!r}")
+        return os.path.join(self.config.partitions_root, notebook_id)
+
+    def _load_partition(self, notebook_id: str) -> NotebookPartition:
+        partition_dir = self._partition_dir(notebook_id)
+        return NotebookPartition(
+            notebook_id=notebook_id,
+            index_path=os.path.join(partition_dir, "faiss_index"),
+            store_path=os.path.join(partition_dir, "document_store"),
+            legacy_docs_path=os.path.join(partition_dir, "documents.pkl"),
+            embeddings=self.embeddings,
+            child_splitter=self.child_splitter,
+            retrieval_k=self.config.retrieval_k,
+            vector_index_config=self.config.vector_index,
+            bm25_config=self.bm25_config,
+            retriever=self.hybrid_retriever
+        )
+
+    def get_partition(self, notebook_id: str = None) -> NotebookPartition:
+        return self.partitions.get(notebook_id or DEFAULT_PARTITION)
+
+    def has_legacy_partition(self) -> bool:
+        """Whether the pre-notebook global index (faiss_index/, documents.pkl) exists on disk."""
+        partition_dir = self._partition_dir(DEFAULT_PARTITION)
+        return any(
+            os.path.exists(os.path.join(partition_dir, name))
+            for name in ("faiss_index", "documents.pkl", "document_store")
+        )
 
-    def list_ingested_files(self) -> List[str]:
+    def migrate_legacy_partition(self, source_notebooks: Dict[str, List[str]]) -> Dict[str, int]:
+        """
+        Move the sources of the legacy global index into the partitions of the notebooks they were
+        uploaded to (`source_notebooks`: source path -> notebook ids). Pages, parents and child vectors
+        are copied as they are, nothing is re-parsed or re-embedded. A source is removed from the legacy
+        index once every notebook has it, so running this again only picks up what is left; sources
+        without a notebook stay where they are. Returns the pages moved per notebook.
+        """
+        moved: Dict[str, int] = {}
+        with self.partitions.pinned(DEFAULT_PARTITION) as legacy:
+            for source in legacy.list_sources():
+                notebook_ids = [nid for nid in source_notebooks.get(source, []) if nid != DEFAULT_PARTITION]
+                if not notebook_ids:
+                    continue
+                exported = legacy.export_source(source)
+                for notebook_id in notebook_ids:
+                    with self.partitions.pinned(notebook_id) as partition:
+                        if source in partition.snapshot().sources:
+                            continue
+                        partition.index_chunks(*exported)
+                        self.partitions.refresh(notebook_id)
+                        self._invalidate_caches(notebook_id)
+                        moved[notebook_id] = moved.get(notebook_id, 0) + len(exported[0])
+                legacy.delete_source(source)
+                self._invalidate_caches(DEFAULT_PARTITION)
+            self.partitions.refresh(DEFAULT_PARTITION)
+        return moved
+
+    def list_ingested_files(self, notebook_id: str = None) -> List[str]:
         """Return a list of unique source files ingested"""
-        sources = set()
-        for doc in self.all_documents:
-            sources.add(doc.metadata.get("source", "Unknown"))
-        return sorted(list(sources))
+        return self.get_partition(notebook_id).list_sources()
 
     def _setup_environment(self):
         if not os.environ.get(self.config.parsing_api_key_env):
@@ -135,107 +296,312 @@ class RAGSystem:
         if not os.environ.get(self.config.llm_api_key_env):
             print(f"Warning: {self.config.llm_api_key_env} not set.")
 
-    def ingest(self, file_paths: List[str]):
+    def ingest(
+        self,
+        file_paths: List[str],
+        notebook_id: str = None,
+        progress: Callable[[str, int], None] = None,
+        indexed: Callable[[List[str]], None] = None,
+    ) -> Dict[str, Any]:
+        """
+        Parse and index files into a notebook's partition.
+        Files stream through parse -> clean -> chunk -> embed -> index, so the first file is searchable
+        while the others are still parsing, and only a few files' worth of data is in memory at once.
+        `progress(stage, count)` is called with running totals: "parsed" (files), "chunked"/"embedded" (chunks)
+        and "indexed" (pages). `indexed(paths)` is called with the files of each published batch.
+        Returns the number of pages indexed, the files that failed to parse and the per-stage counters.
+        """
+        with self.partitions.pinned(notebook_id or DEFAULT_PARTITION) as partition:
+            return self._ingest(partition, file_paths, progress, indexed)
+
+    def _ingest(
+        self,
+        partition: NotebookPartition,
+        file_paths: List[str],
+        progress: Optional[Callable[[str, int], None]],
+        indexed: Optional[Callable[[List[str]], None]],
+    ) -> Dict[str, Any]:
         print(f"Starting ingestion for {len(file_paths)} files...")
-        
-        results = parser.parse_multiple_paths_parallel(file_paths)
-        
-        new_documents = []
-        
-        for path, (data, tokens, all_text) in results.items():
-            if isinstance(data, str) and data.startswith("Error"):
-                print(f"Skipping {path}: {data}")
-                continue
-                
-            self.total_tokens += tokens
+        report = progress or (lambda stage, count: None)
+        skipped = []
+        totals = {"parsed": 0, "chunked": 0, "embedded": 0, "indexed": 0}
+        totals_lock = threading.Lock()
+
+        def count(stage: str, n: int):
+            with totals_lock:
+                totals[stage] += n
+                total = totals[stage]
+            report(stage, total)
+
+        def parse(path):
             try:
-                pages = data.pages
-            except AttributeError:
-                if isinstance(data, dict) and "pages" in data:
-                    pages = data["pages"]
-                else:
-                    pages = [{"text": all_text, "page_number": 1}]
-            
-            for i, page in enumerate(pages):
-                page_text = ""
-                if hasattr(page, "text"):
-                    page_text = parser.remove_footer(page.text)
-                elif isinstance(page, dict):
-                    page_text = parser.remove_footer(page.get("text", ""))
-                
-                if page_text.strip():
-                    doc = Document(
-                        page_content=page_text,
-                        metadata={"source": path, "page": i + 1}
-                    )
-                    new_documents.append(doc)
-        
-        if not new_documents:
+                data, tokens, all_text = parser.parse_single_path(path, cache=self.parse_cache)
+            except Exception as e:
+                print(f"Skipping {path}: {e}")
+                skipped.append(path)
+                return None
+            count("parsed", 1)
+            return path, data, tokens, all_text
+
+        def clean(item):
+            path, data, _, all_text = item
+            documents = self._page_documents(path, data, all_text)
+            if not documents:
+                return None
+            # Counted once here and cached per page by the document store
+            return documents, self.token_counter.count_many([doc.page_content for doc in documents])
+
+        def chunk(item):
+            documents, page_tokens = item
+            children, parents = partition.split_documents(documents)
+            count("chunked", len(children))
+            return documents, page_tokens, children, parents
+
+        def embed(items):
+            # Small files are embedded together, so batches stay full
+            texts = [child.page_content for _, _, children, _ in items for child in children]
+            vectors = self.embeddings.embed_documents(texts) if texts else []
+            count("embedded", len(texts))
+            return items, vectors
+
+        def index(batches):
+            # Files that finished embedding meanwhile are published in one snapshot
+            documents, page_tokens, children, parents, vectors = [], [], [], [], []
+            for items, batch_vectors in batches:
+                vectors.extend(batch_vectors)
+                for item_documents, item_tokens, item_children, item_parents in items:
+                    documents.extend(item_documents)
+                    page_tokens.extend(item_tokens)
+                    children.extend(item_children)
+                    parents.extend(item_parents)
+            partition.index_chunks(documents, children, parents, vectors, page_tokens=page_tokens)
+            self.partitions.refresh(partition.notebook_id)
+            self._invalidate_caches(partition.notebook_id)
+            count("indexed", len(documents))
+            if indexed is not None:
+                indexed(list(dict.fromkeys(doc.metadata["source"] for doc in documents)))
+            return None
+
+        pipeline = StagedPipeline(
+            [
+                PipelineStage("parse", parse, workers=self.config.ingest.get("parse_workers", 10)),
+                PipelineStage("clean", clean),
+                PipelineStage("chunk", chunk),
+                PipelineStage("embed", embed, collect=True, max_items=self.config.ingest.get("embed_max_files", 8)),
+                PipelineStage("index", index, collect=True),
+            ],
+            queue_size=self.config.ingest.get("queue_size", 4)
+        )
+        pipeline.run(file_paths)
+        pipeline.print_stats()
+
+        if not totals["indexed"]:
             print("No new documents to ingest.")
-            return
+        else:
+            print(f"Ingestion complete. Total tokens: {partition.total_tokens}")
+        return {"documents": totals["indexed"], "skipped": skipped, "pipeline": pipeline.stats()}
 
-        self.all_documents.extend(new_documents)
-        
-        self.parent_retriever.add_documents(new_documents)
-        
-        self.vector_db_client.save()
-        
-        self.bm25_retriever = BM25Retriever.from_documents(self.all_documents)
-        self.bm25_retriever.k = self.config.retrieval_k
-        
-        self.ensemble_retriever = EnsembleRetriever(
-            retrievers=[self.parent_retriever, self.bm25_retriever],
-            weights=[0.5, 0.5] # Equal weight
+    def _page_documents(self, path: str, data: Any, all_text: str) -> List[Document]:
+        """One Document per non-empty parsed page, with crawler footers removed."""
+        try:
+            pages = data.pages
+        except AttributeError:
+            if isinstance(data, dict) and "pages" in data:
+                pages = data["pages"]
+            else:
+                pages = [{"text": all_text, "page_number": 1}]
+
+        documents = []
+        for i, page in enumerate(pages):
+            page_text = ""
+            if hasattr(page, "text"):
+                page_text = parser.remove_footer(page.text)
+            elif isinstance(page, dict):
+                page_text = parser.remove_footer(page.get("text", ""))
+
+            if page_text.strip():
+                documents.append(Document(
+                    page_content=page_text,
+                    metadata={"source": path, "page": i + 1}
+                ))
+        return documents
+
+    def delete_source(self, source: str, notebook_id: str = None) -> bool:
+        """Remove an ingested file from a notebook's indexes."""
+        with self.partitions.pinned(notebook_id or DEFAULT_PARTITION) as partition:
+            deleted = partition.delete_source(source)
+            if deleted:
+                self.partitions.refresh(partition.notebook_id)
+                self._invalidate_caches(partition.notebook_id)
+        return deleted
+
+    def _invalidate_caches(self, notebook_id: str):
+        self.context_cache.invalidate(notebook_id)
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(notebook_id)
+        if self.llm_client.context_cache_provider is not None:
+            self.llm_client.drop_cached_contexts(notebook_id)
+
+    def prepare_query(self, user_query: str) -> QueryContext:
+        """Embed (when needed) and classify a query once; the result is passed to query()."""
+        context = QueryContext(user_query, self.embeddings.embed_query)
+        query_embedding = None
+        if self.intent_shares_embedding and not self.intent_classifier.is_chit_chat(user_query):
+            query_embedding = context.embedding
+        context.intent, context.probabilities = self.intent_classifier.classify(user_query, query_embedding)
+        return context
+
+    def query(self, user_query: str, file_filters: List[str] = None, notebook_id: str = None, context: QueryContext = None) -> str:
+        if context is None:
+            context = self.prepare_query(user_query)
+        prepared = self._prepare_answer(context, file_filters, notebook_id)
+        if prepared.answer is not None:
+            return prepared.answer
+
+        answer = None
+        if prepared.cached_context is not None:
+            try:
+                answer = self.llm_client.invoke_with_cached_context(*prepared.cached_context)
+            except Exception as e:
+                print(f"Error using provider context cache, sending full prompt: {e}")
+        if answer is None:
+            answer = self.llm_client.invoke(prepared.prompt).content
+
+        self._remember_answer(prepared, context, answer)
+        return answer
+
+    async def aprepare_query(self, user_query: str) -> QueryContext:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.query_executor, self.prepare_query, user_query)
+
+    async def aquery(self, user_query: str, file_filters: List[str] = None, notebook_id: str = None, context: QueryContext = None) -> str:
+        """
+        Async query(): embedding, intent, search and context assembly run on the bounded query executor
+        and the LLM is awaited through its async API, so the event loop is never blocked.
+        """
+        loop = asyncio.get_running_loop()
+        if context is None:
+            context = await self.aprepare_query(user_query)
+        prepared = await loop.run_in_executor(
+            self.query_executor, self._prepare_answer, context, file_filters, notebook_id
         )
-        
-        self._save_state()
-        
-        print(f"Ingestion complete. Total estimated tokens: {self.total_tokens}")
+        if prepared.answer is not None:
+            return prepared.answer
+
+        answer = None
+        if prepared.cached_context is not None:
+            try:
+                answer = await self.llm_client.ainvoke_with_cached_context(*prepared.cached_context)
+            except Exception as e:
+                print(f"Error using provider context cache, sending full prompt: {e}")
+        if answer is None:
+            answer = (await self.llm_client.ainvoke(prepared.prompt)).content
+
+        self._remember_answer(prepared, context, answer)
+        return answer
+
+    async def astream(self, user_query: str, file_filters: List[str] = None, notebook_id: str = None, context: QueryContext = None) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Streaming aquery(). Yields ("metadata", {intent, mode, citations}) once retrieval is done,
+        then ("token", text) chunks as the LLM produces them. The answer is only cached when the stream completes.
+        """
+        loop = asyncio.get_running_loop()
+        if context is None:
+            context = await self.aprepare_query(user_query)
+        prepared = await loop.run_in_executor(
+            self.query_executor, self._prepare_answer, context, file_filters, notebook_id
+        )
+        yield "metadata", {"intent": prepared.intent, "mode": prepared.mode, "citations": prepared.citations}
+        if prepared.answer is not None:
+            yield "token", prepared.answer
+            return
 
-    def query(self, user_query: str, file_filters: List[str] = None) -> str:
+        chunks = []
+        if prepared.cached_context is not None:
+            try:
+                async for chunk in self.llm_client.astream_with_cached_context(*prepared.cached_context):
+                    chunks.append(chunk)
+                    yield "token", chunk
+            except Exception as e:
+                # Tokens already sent cannot be taken back, so only fall back before the first one
+                if chunks:
+                    raise
+                print(f"Error using provider context cache, sending full prompt: {e}")
+        if not chunks:
+            async for chunk in self.llm_client.astream(prepared.prompt):
+                chunks.append(chunk)
+                yield "token", chunk
+
+        self._remember_answer(prepared, context, "".join(chunks))
+
+    def _prepare_answer(self, context: QueryContext, file_filters: List[str] = None, notebook_id: str = None) -> PreparedAnswer:
+        """Everything before the LLM call: intent routing, answer cache, mode selection and prompt assembly."""
+        user_query = context.query
         # 1. Check Intent
-        intent = self.intent_classifier.predict(user_query)
+        intent = context.intent
         print(f"Detected Intent: {intent}")
         
         if intent == "Hardcoded_Chat":
-            return "Hi! How can you help you today? Need help with your documents?"
+            return PreparedAnswer(intent=intent, answer="Hi! How can you help you today? Need help with your documents?")
         
         if intent == "ML_Chat":
-            return self.llm_client.invoke(user_query).content
+            return PreparedAnswer(intent=intent, prompt=user_query)
 
+        # One snapshot for the whole query, so a concurrent ingest or delete is either fully visible or not at all
+        snapshot = self.get_partition(notebook_id).snapshot()
+        # Token totals are kept per source, so mode selection is a few lookups
         if file_filters:
-            filtered_docs = self._get_filtered_docs(file_filters)
-            current_tokens = int(sum(len(doc.page_content) / 4 for doc in filtered_docs))
+            sources = snapshot.resolve_sources(file_filters)
+            current_tokens = snapshot.source_tokens(sources)
         else:
-            current_tokens = self.total_tokens
-            filtered_docs = self.all_documents
+            sources = None
+            current_tokens = snapshot.total_tokens
 
-        MAX_WINDOW = 1000000 
-        threshold = MAX_WINDOW * self.config.threshold_ratio
+        answer_key = None
+        if self.answer_cache is not None:
+            answer_key = SemanticAnswerCache.make_key(snapshot.notebook_id, sources, snapshot.version)
+            cached_answer = self.answer_cache.lookup(answer_key, context.embedding)
+            if cached_answer is not None:
+                print("Answer cache hit")
+                return PreparedAnswer(intent=intent, answer=cached_answer)
+
+        threshold = self.full_context_budget
         
         print(f"Current tokens (filtered): {current_tokens}, Threshold: {threshold}")
         
         if current_tokens < threshold:
             print("Mode: Full Context")
-            return self._query_full_context(user_query, filtered_docs)
+            prepared = self._prepare_full_context(context, snapshot, sources, current_tokens)
         else:
             print("Mode: RAG (Hybrid)")
-            return self._query_rag(user_query, file_filters)
-
-    def _get_filtered_docs(self, file_filters: List[str]) -> List[Document]:
-        filtered = []
-        for doc in self.all_documents:
-            source = doc.metadata.get("source", "")
-            if any(f in source for f in file_filters):
-                filtered.append(doc)
-        return filtered
-
-    def _query_full_context(self, user_query: str, docs: List[Document]) -> str:
-        context = ""
-        for doc in docs:
-            source = os.path.basename(doc.metadata.get("source", "unknown"))
-            page = doc.metadata.get("page", "unknown")
-            context += f"--- Source: {source}, Page: {page} ---\n{doc.page_content}\n\n"
+            prepared = self._prepare_rag(context, snapshot, file_filters)
+        prepared.intent = intent
+        prepared.answer_key = answer_key
+        return prepared
+
+    def _remember_answer(self, prepared: PreparedAnswer, context: QueryContext, answer: str):
+        if prepared.answer_key is not None and self.answer_cache is not None:
+            self.answer_cache.store(prepared.answer_key, context.embedding, answer)
+
+    def _prepare_full_context(self, query_context: QueryContext, snapshot: PartitionSnapshot, sources: List[str], current_tokens: int) -> PreparedAnswer:
+        user_query = query_context.query
+        if sources is not None and not sources:
+            # The file filters matched nothing; don't ask the model over an empty context
+            return PreparedAnswer(mode="Full Context", answer=NO_RELEVANT_DOCUMENTS_MESSAGE)
+        cache_key = ContextCache.make_key(snapshot.notebook_id, sources, snapshot.version)
+        context = self.context_cache.get_or_build(
+            cache_key,
+            lambda: self._pack_full_context(snapshot, sources)
+        )
+
+        cached_context = None
+        if self.llm_client.context_cache_provider is not None and current_tokens >= self.provider_cache_min_tokens:
+            cached_context = (
+                cache_key,
+                FULL_CONTEXT_INSTRUCTION,
+                f"Context:\n{context}",
+                f"Question: {user_query}"
+            )
         
         prompt = f"""
         You are a helpful assistant. Answer the user's question based on the following context.
@@ -248,31 +614,43 @@ class RAGSystem:
         Question: {user_query}
         """
         
-        response = self.llm_client.invoke(prompt)
-        return response.content
+        citations = [{"source": os.path.basename(source), "page": None} for source in (snapshot.list_sources() if sources is None else sources)]
+        return PreparedAnswer(mode="Full Context", prompt=prompt, cached_context=cached_context, citations=citations)
 
-    def _query_rag(self, user_query: str, file_filters: List[str] = None) -> str:
-        if not self.ensemble_retriever:
-            return "Error: No documents indexed."
+    def _pack_full_context(self, snapshot: PartitionSnapshot, sources: Optional[List[str]]) -> str:
+        store = snapshot.partition.store
+        positions = snapshot.document_positions(sources)
+        docs = store.get_many(positions)
+        # Pages stay in reading order; only boilerplate and repeated pages are removed
+        packed = self.context_packer.pack(
+            docs,
+            budget_tokens=self.full_context_budget,
+            page_tokens=[store.page_tokens(position) for position in positions],
+        )
+        print(
+            f"Packed full context: {len(packed.documents)}/{len(docs)} pages, {packed.tokens} tokens "
+            f"({packed.duplicates} duplicates, {packed.over_budget} over budget)"
+        )
+        return packed.text
+
+    def _prepare_rag(self, query_context: QueryContext, snapshot: PartitionSnapshot, file_filters: List[str] = None) -> PreparedAnswer:
+        user_query = query_context.query
+        if not len(snapshot):
+            return PreparedAnswer(mode="RAG", answer=NO_DOCUMENTS_MESSAGE)
             
-        docs = self.ensemble_retriever.invoke(user_query)
-        
-        if file_filters:
-            filtered_docs = []
-            for doc in docs:
-                source = doc.metadata.get("source", "")
-                if any(f in source for f in file_filters):
-                    filtered_docs.append(doc)
-            docs = filtered_docs
+        docs = snapshot.retrieve(user_query, file_filters, query_embedding=query_context.embedding)
             
         if not docs:
-            return "No relevant documents found in the selected files."
+            return PreparedAnswer(mode="RAG", answer=NO_RELEVANT_DOCUMENTS_MESSAGE)
         
-        context = ""
-        for doc in docs:
-            source = os.path.basename(doc.metadata.get("source", "unknown"))
-            page = doc.metadata.get("page", "unknown")
-            context += f"--- Source: {source}, Page: {page} ---\n{doc.page_content}\n\n"
+        # Overlapping parents from the dense and sparse legs are deduplicated and the rest diversified
+        packed = self.context_packer.pack(docs, diversify=True, page_tokens=snapshot.page_tokens(docs))
+        print(
+            f"Packed {len(packed.documents)}/{len(docs)} passages, {packed.tokens} tokens "
+            f"({packed.duplicates} duplicates, {packed.over_budget} over budget)"
+        )
+        docs = packed.documents
+        context = packed.text
         
         prompt = f"""
         You are a helpful assistant. Answer the user's question based on the following retrieved context.
@@ -284,15 +662,19 @@ class RAGSystem:
         Question: {user_query}
         """
         
-        response = self.llm_client.invoke(prompt)
-        return response.content
+        citations = [
+            {"source": os.path.basename(doc.metadata.get("source", "unknown")), "page": doc.metadata.get("page")}
+            for doc in docs
+        ]
+        return PreparedAnswer(mode="RAG", prompt=prompt, citations=citations)
 
-    def debug_retrieval(self, user_query: str):
+    def debug_retrieval(self, user_query: str, notebook_id: str = None):
         """Debug retrieval performance by showing vector and BM25 results"""
         print(f"\n{'='*60}")
         print(f"DEBUG RETRIEVAL: '{user_query}'")
         
-        intent = self.intent_classifier.predict(user_query)
+        query_context = self.prepare_query(user_query)
+        intent = query_context.intent
         print(f"Detected Intent: {intent}")
         
         if intent in ["Hardcoded_Chat", "ML_Chat"]:
@@ -301,47 +683,43 @@ class RAGSystem:
             return
 
         print(f"{'='*60}")
-        
-        print("\n[Vector Search Results]")
-        print("-" * 60)
-        try:
-            vector_results = self.vectorstore.similarity_search_with_score(user_query, k=self.config.retrieval_k)
-            for i, (doc, score) in enumerate(vector_results):
+        snapshot = self.get_partition(notebook_id).snapshot()
+        if not len(snapshot):
+            print("No documents indexed.")
+            return
+
+        # One hybrid search; the per-leg scores of every hit come back with it
+        start = time.perf_counter()
+        hits = snapshot.search(user_query, query_embedding=query_context.embedding)
+        print(f"Hybrid search: {len(hits)} pages in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        def show(title: str, ranked: List[Tuple[Document, float, Dict[str, float]]], label: Callable[[float, Dict[str, float]], str]):
+            print(f"\n\n[{title}]")
+            print("-" * 60)
+            if not ranked:
+                print("No results.")
+            for i, (doc, fused_score, leg_scores) in enumerate(ranked):
                 source = os.path.basename(doc.metadata.get("source", "unknown"))
                 page = doc.metadata.get("page", "unknown")
-                print(f"\n{i+1}. L2 Distance: {score:.4f}")
+                print(f"\n{i+1}. {label(fused_score, leg_scores)}")
                 print(f"   Source: {source} | Page: {page}")
                 print(f"   Content: {doc.page_content[:150]}...")
-        except Exception as e:
-            print(f"Error during vector search: {e}")
 
-        print("\n\n[BM25 Search Results]")
-        print("-" * 60)
-        if self.bm25_retriever:
-            try:
-                bm25_results = self.bm25_retriever.invoke(user_query)
-                for i, doc in enumerate(bm25_results):
-                    source = os.path.basename(doc.metadata.get("source", "unknown"))
-                    page = doc.metadata.get("page", "unknown")
-                    print(f"\n{i+1}. Source: {source} | Page: {page}")
-                    print(f"   Content: {doc.page_content[:150]}...")
-            except Exception as e:
-                print(f"Error during BM25 search: {e}")
-        else:
-            print("BM25 Retriever not initialized.")
-        
-        print("\n\n[Ensemble (Combined) Results]")
-        print("-" * 60)
-        if self.ensemble_retriever:
-            try:
-                ensemble_results = self.ensemble_retriever.invoke(user_query)
-                for i, doc in enumerate(ensemble_results):
-                    source = os.path.basename(doc.metadata.get("source", "unknown"))
-                    page = doc.metadata.get("page", "unknown")
-                    print(f"\n{i+1}. Source: {source} | Page: {page}")
-                    print(f"   Content: {doc.page_content[:150]}...")
-            except Exception as e:
-                print(f"Error during ensemble search: {e}")
+        show(
+            "Vector Search Results",
+            sorted((hit for hit in hits if "dense" in hit[2]), key=lambda hit: hit[2]["dense"]),
+            lambda _, legs: f"L2 Distance: {legs['dense']:.4f}"
+        )
+        show(
+            "BM25 Search Results",
+            sorted((hit for hit in hits if "sparse" in hit[2]), key=lambda hit: -hit[2]["sparse"]),
+            lambda _, legs: f"BM25 Score: {legs['sparse']:.4f}"
+        )
+        show(
+            "Hybrid (Fused) Results",
+            hits,
+            lambda fused, legs: f"Fused: {fused:.4f} | " + ", ".join(f"{leg}: {score:.4f}" for leg, score in legs.items())
+        )
         
         print(f"\n{'='*60}\n")
         
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+    from ai.rag_system import RAGSystem
+
+DEFAULT_CONFIG_PATH = "ai/config.yaml"
+# A failed warm-up is retried by the next request that needs the RAG system, at most this often
+WARMUP_RETRY_SECONDS = 30
+
+# Process-wide instances, so every component of one worker shares the same weights and indexes
+_models: Dict[Tuple[str, str], "SentenceTransformer"] = {}
+_rag_systems: Dict[str, "RAGSystem"] = {}
+_lock = threading.Lock()
+_rag_lock = threading.Lock()
+
+# Background warm-up state, keyed like _rag_systems
+_warmups: Dict[str, Dict[str, Any]] = {}
+
+
+def _model_key(model_name: str, device: str) -> Tuple[str, str]:
+    # "all-MiniLM-L6-v2" and "sentence-transformers/all-MiniLM-L6-v2" are the same hub model
+    if "/" not in model_name and not os.path.exists(model_name):
+        model_name = f"sentence-transformers/{model_name}"
+    return (model_name, device)
+
+
+def get_sentence_transformer(model_name: str, device: str = "cpu") -> "SentenceTransformer":
+    """Return the shared SentenceTransformer for (model, device), loading it on first use."""
+    # Imported here so that importing the registry does not load torch
+    from sentence_transformers import SentenceTransformer
+
+    key = _model_key(model_name, device)
+    with _lock:
+        model = _models.get(key)
+        if model is None:
+            print(f"Loading SentenceTransformer {key[0]} on {device}")
+            model = SentenceTransformer(key[0], device=device)
+            _models[key] = model
+        return model
+
+
+def get_rag_system(config_path: str = DEFAULT_CONFIG_PATH) -> "RAGSystem":
+    """Return the shared RAGSystem (and its indexes) for a config file, building it on first use."""
+    from ai.rag_system import RAGSystem
+
+    key = os.path.abspath(config_path)
+    # A separate lock, because building a RAGSystem loads models through get_sentence_transformer
+    with _rag_lock:
+        rag = _rag_systems.get(key)
+        if rag is None:
+            rag = RAGSystem(config_path)
+            _rag_systems[key] = rag
+        return rag
+
+
+def start_warmup(config_path: str = DEFAULT_CONFIG_PATH):
+    """
+    Build the RAGSystem (models and intent classifier) in a background thread.
+    Calling it again is a no-op, unless the last attempt failed at least WARMUP_RETRY_SECONDS ago.
+    """
+    key = os.path.abspath(config_path)
+    with _lock:
+        state = _warmups.get(key)
+        if state is not None:
+            failed_at = state.get("failed_at")
+            if failed_at is None or time.time() - failed_at < WARMUP_RETRY_SECONDS:
+                return
+            print(f"Retrying RAG system warm-up after error: {state['error']}")
+        _warmups[key] = {"started_at": time.time(), "finished_at": None, "failed_at": None, "error": None}
+    threading.Thread(target=_warm_up, args=(config_path, key), name="rag-warmup", daemon=True).start()
+
+
+def _warm_up(config_path: str, key: str):
+    state = _warmups[key]
+    try:
+        rag = get_rag_system(config_path)
+        # One query through the embedding model and classifier; notebook partitions load on first use
+        rag.prepare_query("warm up")
+        state["finished_at"] = time.time()
+        print(f"RAG system ready in {state['finished_at'] - state['started_at']:.1f}s")
+    except Exception as e:
+        state["error"] = str(e)
+        state["failed_at"] = time.time()
+        print(f"Error warming up RAG system: {e}")
+
+
+def get_ready_rag_system(config_path: str = DEFAULT_CONFIG_PATH) -> Optional["RAGSystem"]:
+    """Return the RAGSystem once warm-up has finished, otherwise None (starting or retrying warm-up if needed)."""
+    key = os.path.abspath(config_path)
+    state = _warmups.get(key)
+    if state is None or state["failed_at"] is not None:
+        start_warmup(config_path)
+        return None
+    if state["finished_at"] is None:
+        return None
+    return _rag_systems.get(key)
+
+
+def warmup_status(config_path: str = DEFAULT_CONFIG_PATH) -> Dict[str, Any]:
+    state = _warmups.get(os.path.abspath(config_path))
+    if state is None:
+        return {"ready": False, "started": False, "error": None}
+    finished_at = state["finished_at"]
+    return {
+        "ready": finished_at is not None,
+        "started": True,
+        "error": state["error"],
+        "seconds": (finished_at or time.time()) - state["started_at"],
+    }
@@ -0,0 +1,59 @@
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# Letters that carry their diacritic in the base character, so NFD decomposition does not strip it
+_FOLD_TABLE = str.maketrans({"đ": "d", "Đ": "D", "ø": "o", "Ø": "O", "ł": "l", "Ł": "L", "ß": "ss"})
+
+
+def fold_diacritics(text: str) -> str:
+    """"Tiếng Việt" -> "Tieng Viet": strip combining marks and map đ/ø/ł to their base letters."""
+    decomposed = unicodedata.normalize("NFD", text.translate(_FOLD_TABLE))
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+class Analyzer:
+    """
+    Text -> index terms for sparse retrieval.
+    NFKC normalization (full-width forms, ligatures), case folding, optional diacritics folding so
+    Vietnamese typed with or without accents matches, then word tokenization. Extra `filters`
+    (e.g. stopword removal or stemming) run on the token list in order.
+    """
+
+    def __init__(
+        self,
+        fold_accents: bool = True,
+        min_length: int = 1,
+        stopwords: Optional[Iterable[str]] = None,
+        filters: Optional[List[Callable[[List[str]], List[str]]]] = None,
+        query_cache_size: int = 4096,
+    ):
+        self.fold_accents = fold_accents
+        self.min_length = min_length
+        self.stopwords = frozenset(stopwords or ())
+        self.filters = list(filters or [])
+        # Queries repeat a lot (retries, answer cache misses, debug), documents are analyzed once at ingest
+        self.analyze_query = lru_cache(maxsize=query_cache_size)(lambda query: tuple(self(query)))
+
+    def normalize(self, text: str) -> str:
+        if text.isascii():
+            return text.lower()
+        text = unicodedata.normalize("NFKC", text).casefold()
+        if self.fold_accents:
+            text = fold_diacritics(text)
+        return text
+
+    def __call__(self, text: str) -> List[str]:
+        tokens = [
+            token for token in _TOKEN.findall(self.normalize(text))
+            if len(token) >= self.min_length and token not in self.stopwords
+        ]
+        for token_filter in self.filters:
+            tokens = token_filter(tokens)
+        return tokens
+
+
+default_analyzer = Analyzer()
@@ -0,0 +1,207 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+
+from config.database import db
+
+job_collection = db["ingest_jobs"]
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+
+STAGES = ("parsed", "chunked", "embedded", "indexed")
+
+
+def run_ingest_job(
+    job: Dict[str, Any],
+    progress: Callable[[str, int], None],
+    indexed: Callable[[List[str]], None],
+) -> Dict[str, Any]:
+    """
+    Ingest a job's files into its notebook. Runs in a worker thread.
+    Files an earlier attempt recorded as indexed are skipped. Any other file of the job may have been
+    indexed by an attempt that died before recording it, so on retries it is deleted before re-ingesting.
+    """
+    from ai.registry import get_rag_system
+
+    # Waits for the background warm-up if it is still building the RAG system
+    rag = get_rag_system()
+    done = set(job.get("indexed_paths") or [])
+    paths = [path for path in job["paths"] if path not in done]
+    if job["attempts"] > 1:
+        for path in paths:
+            rag.delete_source(path, notebook_id=job["notebookId"])
+    result = rag.ingest(paths, notebook_id=job["notebookId"], progress=progress, indexed=indexed)
+    if result["skipped"] and not result["documents"]:
+        raise RuntimeError(f"No file could be parsed: {result['skipped']}")
+    return result
+
+
+class IngestJobQueue:
+    """
+    Durable ingestion queue.
+    Jobs are documents in Mongo, so they survive restarts. A fixed number of async workers claim them
+    atomically and run the ingestion in a thread. A running job holds a lease that its worker keeps
+    extending; when a process dies, the lease expires and another worker picks the job up again.
+    Failed jobs are retried with a growing delay until `max_attempts`. Files are recorded in
+    `indexed_paths` as soon as they are indexed, so a retry does not index them twice.
+    """
+
+    def __init__(
+        self,
+        run_job: Callable[[Dict[str, Any], Callable[[str, int], None], Callable[[List[str]], None]], Dict[str, Any]],
+        workers: int = 2,
+        max_attempts: int = 3,
+        lease_seconds: int = 120,
+        retry_delay_seconds: int = 30,
+        poll_seconds: float = 5.0,
+    ):
+        self.run_job = run_job
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.retry_delay_seconds = retry_delay_seconds
+        self.poll_seconds = poll_seconds
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def start(self):
+        await job_collection.create_index([("status", 1), ("run_after", 1)])
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, notebook_id: str, paths: List[str]) -> str:
+        now = datetime.now(timezone.utc)
+        result = await job_collection.insert_one({
+            "notebookId": notebook_id,
+            "paths": paths,
+            "status": "queued",
+            "attempts": 0,
+            "progress": {stage: 0 for stage in STAGES},
+            "indexed_paths": [],
+            "error": None,
+            "result": None,
+            "created_at": now,
+            "updated_at": now,
+            "run_after": now,
+        })
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return str(result.inserted_id)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            obj_id = ObjectId(job_id)
+        except InvalidId:
+            return None
+        job = await job_collection.find_one({"_id": obj_id}, {"lease_until": 0, "run_after": 0})
+        if job:
+            job["id"] = str(job.pop("_id"))
+        return job
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        now = datetime.now(timezone.utc)
+        return await job_collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_after": {"$lte": now}},
+                # Running jobs whose worker stopped renewing the lease
+                {"status": "running", "lease_until": {"$lt": now}},
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "lease_until": now + timedelta(seconds=self.lease_seconds),
+                    "progress": {stage: 0 for stage in STAGES},
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                print(f"Error claiming ingest job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Dict[str, Any]):
+        job_id = job["_id"]
+        loop = asyncio.get_running_loop()
+        print(f"Running ingest job {job_id} (attempt {job['attempts']}/{self.max_attempts})")
+
+        def progress(stage: str, count: int):
+            # Called from the ingest thread. Counts are running totals and the updates may complete out
+            # of order, so $max keeps a late, smaller count from moving a counter backwards
+            asyncio.run_coroutine_threadsafe(
+                job_collection.update_one({"_id": job_id}, {"$max": {f"progress.{stage}": count}}), loop
+            )
+
+        def indexed(paths: List[str]):
+            # Waits for the write, so a file is recorded before the next batch is indexed
+            asyncio.run_coroutine_threadsafe(
+                job_collection.update_one({"_id": job_id}, {"$addToSet": {"indexed_paths": {"$each": paths}}}), loop
+            ).result()
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            result = await asyncio.to_thread(self.run_job, job, progress, indexed)
+            await job_collection.update_one(
+                {"_id": job_id},
+                {"$set": {
+                    "status": "done",
+                    "result": result,
+                    "error": None,
+                    "updated_at": datetime.now(timezone.utc),
+                }, "$unset": {"lease_until": ""}}
+            )
+            print(f"Ingest job {job_id} done")
+        except Exception as e:
+            now = datetime.now(timezone.utc)
+            retry = job["attempts"] < self.max_attempts
+            print(f"Ingest job {job_id} failed: {e}" + (", retrying" if retry else ""))
+            await job_collection.update_one(
+                {"_id": job_id},
+                {"$set": {
+                    "status": "queued" if retry else "failed",
+                    "error": str(e),
+                    "run_after": now + timedelta(seconds=self.retry_delay_seconds * job["attempts"]),
+                    "updated_at": now,
+                }, "$unset": {"lease_until": ""}}
+            )
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job_id: ObjectId):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            now = datetime.now(timezone.utc)
+            await job_collection.update_one(
+                {"_id": job_id, "status": "running"},
+                {"$set": {"lease_until": now + timedelta(seconds=self.lease_seconds), "updated_at": now}}
+            )
+
+
+ingest_queue = IngestJobQueue(run_ingest_job, workers=INGEST_WORKERS, max_attempts=INGEST_MAX_ATTEMPTS)
@@ -0,0 +1,45 @@
+import asyncio
+import os
+from typing import Dict, List
+
+from config.database import db
+
+file_collection = db["files"]
+
+# Uploads are saved here before ingestion (see routers/filesRouter.py)
+UPLOAD_DIR = "uploads"
+
+
+async def source_notebooks() -> Dict[str, List[str]]:
+    """Ingested source path -> ids of the notebooks whose file_list holds it."""
+    mapping: Dict[str, List[str]] = {}
+    async for doc in file_collection.find({}, {"notebookId": 1, "file_list": 1}):
+        for file in doc.get("file_list", []):
+            if file.get("format") == "url":
+                continue
+            source = file.get("source") or os.path.join(UPLOAD_DIR, file["title"])
+            notebook_ids = mapping.setdefault(source, [])
+            if doc["notebookId"] not in notebook_ids:
+                notebook_ids.append(doc["notebookId"])
+    return mapping
+
+
+async def migrate_legacy_partition():
+    """
+    Move files of the pre-notebook global index into their notebooks' partitions.
+    Runs once per startup in the background, after the RAG system is built; sources that no
+    notebook lists stay in the global index.
+    """
+    from ai.registry import get_rag_system
+
+    try:
+        # Waits for the background warm-up if it is still building the RAG system
+        rag = await asyncio.to_thread(get_rag_system)
+        if not rag.has_legacy_partition():
+            return
+        mapping = await source_notebooks()
+        moved = await asyncio.to_thread(rag.migrate_legacy_partition, mapping)
+        if moved:
+            print(f"Migrated legacy index pages into notebooks: {moved}")
+    except Exception as e:
+        print(f"Error migrating legacy index: {e}")
@@ -1,6 +1,7 @@
 from dotenv import load_dotenv
 load_dotenv()
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from routers import (conversationsRouter as conversations, 
                     filesRouter as files, 
                     notebookRouter as notebooks,
@@ -9,7 +10,11 @@ from routers import (conversationsRouter as conversations,
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 from contextlib import asynccontextmanager
+import asyncio
 from config.database import db
+from ai.registry import start_warmup, warmup_status
+from libs.ingest_jobs import ingest_queue
+from libs.partition_migration import migrate_legacy_partition
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -17,7 +22,14 @@ async def lifespan(app: FastAPI):
     indexes = await collection.index_information()
     if "expireAt_1" not in indexes:
         await collection.create_index("expireAt", expireAfterSeconds=0)
+    # Models load in the background; AI routes answer 503 until they are ready
+    start_warmup()
+    await ingest_queue.start()
+    # Files of the old global index are moved into their notebooks once the RAG system is up
+    migration = asyncio.create_task(migrate_legacy_partition())
     yield
+    migration.cancel()
+    await ingest_queue.stop()
     
 app = FastAPI(
     lifespan=lifespan,
@@ -34,6 +46,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Liveness: the process is up and serving
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# Readiness: the AI stack has finished warming up
+@app.get("/readyz")
+async def readyz():
+    status = warmup_status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
 app.include_router(conversations.router, tags=["conversations"])
 app.include_router(files.router, tags=["files"])
 app.include_router(notebooks.router, tags=["notebooks"])
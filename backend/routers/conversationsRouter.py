@@ -1,15 +1,16 @@
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from schemas.conversationSchema import Conversation, MessageItem
 from config.database import db
 from datetime import datetime, timedelta, timezone
 from bson import ObjectId
 from bson.errors import InvalidId
 import uuid
+import json
+import asyncio
 from typing import List
 from schemas.querySchema import QueryRequest, QueryResponse
-from ai.rag_system import RAGSystem
-
-rag = RAGSystem("ai/config.yaml")
+from routers.dependencies import require_rag
 
 conversation_collection = db["conversations"]
 notebook_collection = db["notebooks"]
@@ -20,7 +21,7 @@ router = APIRouter(
 )
 
 @router.post("/query/{conversationId}", response_model=QueryResponse)
-async def query_rag(conversationId: str, request: QueryRequest):
+async def query_rag(conversationId: str, request: QueryRequest, rag=Depends(require_rag)):
     """
     Query the RAG system.
     """
@@ -47,9 +48,16 @@ async def query_rag(conversationId: str, request: QueryRequest):
             }
         )
 
-        intent = rag.intent_classifier.predict(request.query)
+        # Embedded and classified once, then reused by rag.query
+        query_context = await rag.aprepare_query(request.query)
+        intent = query_context.intent
         
-        response_text = rag.query(request.query, file_filters=request.file_filters)
+        response_text = await rag.aquery(
+            request.query,
+            file_filters=request.file_filters,
+            notebook_id=conversation.get("notebookId"),
+            context=query_context
+        )
         
         assistant_message = {
             "id": str(uuid.uuid4()),
@@ -81,6 +89,96 @@ async def query_rag(conversationId: str, request: QueryRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+# Stream the answer as server-sent events in the AI SDK UI message stream format:
+# retrieval metadata first (data-retrieval part), then text deltas as the LLM produces them
+@router.post("/query_stream/{conversationId}")
+async def query_rag_stream(conversationId: str, request: QueryRequest, rag=Depends(require_rag)):
+    try:
+        obj_id = ObjectId(conversationId)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid conversationId")
+
+    conversation = await conversation_collection.find_one({"_id": obj_id})
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    now = datetime.now(timezone.utc)
+    await conversation_collection.update_one(
+        {"_id": obj_id},
+        {
+            "$push": {"messages": request.message_item.model_dump()},
+            "$set": {
+                "updated_at": now,
+                "expireAt": now + timedelta(days=3)
+            }
+        }
+    )
+
+    message_id = str(uuid.uuid4())
+
+    async def save_answer(text: str):
+        now = datetime.now(timezone.utc)
+        await conversation_collection.update_one(
+            {"_id": obj_id},
+            {
+                "$push": {"messages": {
+                    "id": message_id,
+                    "role": "assistant",
+                    "parts": [{"type": "text", "text": text}]
+                }},
+                "$set": {
+                    "updated_at": now,
+                    "expireAt": now + timedelta(days=3)
+                }
+            }
+        )
+
+    async def event_stream():
+        chunks = []
+        text_id = str(uuid.uuid4())
+        try:
+            yield sse_event({"type": "start", "messageId": message_id})
+            async for kind, value in rag.astream(
+                request.query,
+                file_filters=request.file_filters,
+                notebook_id=conversation.get("notebookId")
+            ):
+                if kind == "metadata":
+                    yield sse_event({"type": "data-retrieval", "data": value})
+                    yield sse_event({"type": "text-start", "id": text_id})
+                else:
+                    chunks.append(value)
+                    yield sse_event({"type": "text-delta", "id": text_id, "delta": value})
+            yield sse_event({"type": "text-end", "id": text_id})
+            yield sse_event({"type": "finish"})
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            yield sse_event({"type": "error", "errorText": str(e)})
+        finally:
+            # Runs at the end of the stream and when the client disconnects; whatever was sent is saved once
+            if chunks:
+                await asyncio.shield(save_answer("".join(chunks)))
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "x-vercel-ai-ui-message-stream": "v1"
+        }
+    )
+
+# Hit/miss counters of the semantic answer cache
+@router.get("/answer_cache/stats", response_model=dict)
+async def get_answer_cache_stats(rag=Depends(require_rag)):
+    if rag.answer_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **rag.answer_cache.stats()}
+
 # Add 1 message into conversation
 @router.patch("/{conversationId}", response_model=dict)
 async def update_conversation(
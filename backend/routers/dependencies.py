@@ -0,0 +1,21 @@
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from ai.registry import get_ready_rag_system, warmup_status
+
+# Shared RAGSystem for AI routes; answers 503 right away while the models and indexes are still loading
+def require_rag():
+    rag = get_ready_rag_system()
+    if rag is None:
+        error = warmup_status()["error"]
+        detail = f"AI service failed to start: {error}" if error else "AI service is warming up"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+    return rag
+
+# Notebook ids name the notebook's index directory, so anything but an ObjectId is rejected before it reaches a path
+def require_notebook_id(notebookId: str) -> str:
+    try:
+        ObjectId(notebookId)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid notebookId format")
+    return notebookId
@@ -8,9 +8,10 @@ from libs.cloudinary import upload_files
 from fastapi import Body
 import os
 import shutil
-from ai.rag_system import RAGSystem
+import asyncio
+from routers.dependencies import require_notebook_id, require_rag
+from libs.ingest_jobs import ingest_queue
 
-rag = RAGSystem("ai/config.yaml")
 file_collection = db["files"]
 
 UPLOAD_DIR = "uploads"
@@ -57,6 +58,7 @@ async def get_all_files(notebookId: str, background_tasks: BackgroundTasks):
 
 @router.post("/upload_files/{notebookId}")
 async def upload_endpoint(notebookId: str, files: List[UploadFile] = File(...)):
+    require_notebook_id(notebookId)
     try:
         # Save physical files locally and collect their paths for ingestion
         saved_paths = []
@@ -73,8 +75,8 @@ async def upload_endpoint(notebookId: str, files: List[UploadFile] = File(...)):
 
             saved_paths.append(file_path)
 
-        # Ingest the saved files into the RAG pipeline
-        rag.ingest(saved_paths)
+        # Ingestion runs in the background job queue; poll /files/ingest_jobs/{jobId} for progress
+        job_id = await ingest_queue.submit(notebookId, saved_paths)
 
         for f in files:
             f.file.seek(0)
@@ -82,6 +84,9 @@ async def upload_endpoint(notebookId: str, files: List[UploadFile] = File(...)):
         # Upload files (store them in your storage system)
         # This returns metadata for each uploaded file
         uploaded_files = await upload_files(files)
+        # Remember which ingested source each upload maps to, so deletes can drop it from the index
+        for uploaded in uploaded_files:
+            uploaded["source"] = os.path.join(UPLOAD_DIR, uploaded["title"])
 
         # Update database with uploaded file metadata
         now = datetime.now(timezone.utc)
@@ -98,7 +103,8 @@ async def upload_endpoint(notebookId: str, files: List[UploadFile] = File(...)):
 
         # Return success response
         return {
-            "message": f"Uploaded and ingested {len(saved_paths)} files successfully.",
+            "message": f"Uploaded {len(saved_paths)} files, ingestion queued.",
+            "jobId": job_id,
             "uploaded_files": uploaded_files,
             "ingested_files": [os.path.basename(p) for p in saved_paths]
         }
@@ -149,6 +155,28 @@ async def upload_url_endpoint(notebookId: str, sources: List[SingleFile] = Body(
     except:
         raise HTTPException(status_code=400, detail="Upload Url Error")
 
+# Ingestion job status and per-stage progress
+@router.get("/ingest_jobs/{jobId}")
+async def get_ingest_job(jobId: str):
+    job = await ingest_queue.get(jobId)
+    if not job:
+        raise HTTPException(status_code=404, detail="Ingest job not found")
+    return job
+
+# Parse cache hit rate and size
+@router.get("/parse_cache/stats")
+async def get_parse_cache_stats():
+    rag = require_rag()
+    if rag.parse_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **rag.parse_cache.stats()}
+
+# Embedding throughput and chunk cache hit rate since startup
+@router.get("/embedding/stats")
+async def get_embedding_stats():
+    rag = require_rag()
+    return rag.embeddings.stats()
+
 # Create new file storage
 @router.post("/create/{notebookId}")
 async def create_file_storage(notebookId: str):
@@ -167,9 +195,19 @@ async def create_file_storage(notebookId: str):
 # Delete single file upload permanently
 @router.delete("/delete/{notebookId}/{public_id}/{format}")
 async def delete_single_file(notebookId: str, public_id: str, format: str):
+    require_notebook_id(notebookId)
     if format != "url":
+        # Only uploaded files are in the index, so URL deletes do not wait for warm-up
+        rag = require_rag()
         await delete_cloud_file(public_id, "raw")
 
+        file_doc = await file_collection.find_one({"notebookId": notebookId})
+        file_item = next((f for f in (file_doc or {}).get("file_list", []) if f["public_id"] == public_id), None)
+        if file_item:
+            source = file_item.get("source") or os.path.join(UPLOAD_DIR, file_item["title"])
+            # Rewrites the notebook's indexes, so it runs off the event loop
+            await asyncio.to_thread(rag.delete_source, source, notebook_id=notebookId)
+
     result = await file_collection.update_one(
         {"notebookId": notebookId},
         {"$pull": {"file_list": {"public_id": public_id}}}
@@ -10,6 +10,7 @@ class SingleFile(BaseModel):
     content: Optional[str] = None
     embedding: Optional[List[float]] = None
     checked: bool = True
+    source: Optional[str] = None # Path of the ingested copy in the RAG index
     created_at: datetime = Field(default_factory=datetime.now)
     updated_at: Optional[datetime] = None
 
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from ai import rag_modules
+from ai.rag_modules import LLMClient
+
+
+class FakeContextCacheProvider:
+    """In-memory stand-in for GeminiContextCacheProvider that records every call."""
+
+    def __init__(self, ttl_seconds: int = 3600, create_delay: float = 0.0):
+        self.ttl_seconds = ttl_seconds
+        self.create_delay = create_delay
+        self.caches = {}
+        self.created = []
+        self.deleted = []
+        self.fail_create = False
+        self.fail_generate = False
+        # When set, create() of that context blocks until the event is set
+        self.block = {}
+        self._lock = threading.Lock()
+
+    def create(self, system_instruction: str, context: str) -> str:
+        if context in self.block:
+            self.block[context].wait(5)
+        time.sleep(self.create_delay)
+        if self.fail_create:
+            raise RuntimeError("upload failed")
+        with self._lock:
+            name = f"cachedContents/{len(self.created)}"
+            self.created.append(context)
+            self.caches[name] = (system_instruction, context)
+        return name
+
+    def generate(self, cache_name: str, question: str) -> str:
+        if self.fail_generate:
+            raise RuntimeError("cache not found")
+        _, context = self.caches[cache_name]
+        return f"{context} | {question}"
+
+    async def agenerate(self, cache_name: str, question: str) -> str:
+        return self.generate(cache_name, question)
+
+    async def agenerate_stream(self, cache_name: str, question: str):
+        for part in self.generate(cache_name, question).split(" | "):
+            yield part
+
+    def delete(self, cache_name: str):
+        self.deleted.append(cache_name)
+        self.caches.pop(cache_name, None)
+
+
+@pytest.fixture
+def provider():
+    return FakeContextCacheProvider()
+
+
+@pytest.fixture
+def client(monkeypatch, provider):
+    # Only the provider cache path is exercised; no chat model is needed
+    monkeypatch.setattr(rag_modules, "ChatGoogleGenerativeAI", lambda **kwargs: None)
+    monkeypatch.setenv("TEST_LLM_KEY", "test")
+    return LLMClient("fake-model", "TEST_LLM_KEY", context_cache_provider=provider)
+
+
+def test_context_is_uploaded_once_per_key(client, provider):
+    key = ("nb1", None, 1)
+    assert client.invoke_with_cached_context(key, "system", "context A", "q1") == "context A | q1"
+    assert client.invoke_with_cached_context(key, "system", "context A", "q2") == "context A | q2"
+    assert provider.created == ["context A"]
+
+    client.invoke_with_cached_context(("nb1", None, 2), "system", "context B", "q1")
+    assert provider.created == ["context A", "context B"]
+
+
+def test_expired_context_is_uploaded_again(client, provider):
+    key = ("nb1", None, 1)
+    client.invoke_with_cached_context(key, "system", "context A", "q1")
+    # Expire the local entry as if the provider TTL had passed
+    name, _ = client._cached_contexts[key]
+    client._cached_contexts[key] = (name, time.time() - 1)
+
+    client.invoke_with_cached_context(key, "system", "context A", "q2")
+    assert provider.created == ["context A", "context A"]
+
+
+def test_concurrent_callers_share_one_upload(client, provider):
+    provider.create_delay = 0.2
+    key = ("nb1", None, 1)
+    names = []
+    threads = [
+        threading.Thread(target=lambda: names.append(client._cached_context_name(key, "system", "context A")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert provider.created == ["context A"]
+    assert len(set(names)) == 1 and len(names) == 8
+
+
+def test_slow_upload_does_not_block_other_keys(client, provider):
+    release = threading.Event()
+    provider.block["slow context"] = release
+    slow = threading.Thread(target=client._cached_context_name, args=(("nb1", None, 1), "system", "slow context"))
+    slow.start()
+    try:
+        while not client._uploads:
+            time.sleep(0.01)
+        start = time.monotonic()
+        assert client.invoke_with_cached_context(("nb2", None, 1), "system", "fast context", "q") == "fast context | q"
+        assert time.monotonic() - start < 1.0
+    finally:
+        release.set()
+        slow.join()
+    assert sorted(provider.created) == ["fast context", "slow context"]
+
+
+def test_failed_upload_is_not_cached(client, provider):
+    key = ("nb1", None, 1)
+    provider.fail_create = True
+    with pytest.raises(RuntimeError):
+        client.invoke_with_cached_context(key, "system", "context A", "q1")
+    assert key not in client._cached_contexts and not client._uploads
+
+    provider.fail_create = False
+    assert client.invoke_with_cached_context(key, "system", "context A", "q1") == "context A | q1"
+
+
+def test_failed_generate_drops_the_entry(client, provider):
+    key = ("nb1", None, 1)
+    client.invoke_with_cached_context(key, "system", "context A", "q1")
+    provider.fail_generate = True
+    with pytest.raises(RuntimeError):
+        client.invoke_with_cached_context(key, "system", "context A", "q2")
+    assert key not in client._cached_contexts
+
+    provider.fail_generate = False
+    client.invoke_with_cached_context(key, "system", "context A", "q3")
+    assert provider.created == ["context A", "context A"]
+
+
+def test_drop_cached_contexts_deletes_only_that_notebook(client, provider):
+    client.invoke_with_cached_context(("nb1", None, 1), "system", "context A", "q")
+    client.invoke_with_cached_context(("nb1", ("a.pdf",), 1), "system", "context B", "q")
+    client.invoke_with_cached_context(("nb2", None, 1), "system", "context C", "q")
+
+    client.drop_cached_contexts("nb1")
+
+    assert sorted(provider.deleted) == ["cachedContents/0", "cachedContents/1"]
+    assert list(client._cached_contexts) == [("nb2", None, 1)]
+
+
+def test_async_paths_use_the_cached_context(client, provider):
+    key = ("nb1", None, 1)
+
+    async def run():
+        answer = await client.ainvoke_with_cached_context(key, "system", "context A", "q1")
+        parts = [part async for part in client.astream_with_cached_context(key, "system", "context A", "q2")]
+        return answer, parts
+
+    answer, parts = asyncio.run(run())
+    assert answer == "context A | q1"
+    assert parts == ["context A", "q2"]
+    assert provider.created == ["context A"]
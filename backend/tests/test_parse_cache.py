@@ -0,0 +1,137 @@
+import json
+import os
+
+import pytest
+
+from ai import parse_cache
+from ai.parse_cache import ParseCache
+
+SETTINGS = {"result_type": "markdown", "language": "en"}
+
+
+class StubParser:
+    """Counts parses and returns one page per line of the file."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, path):
+        self.calls.append(path)
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        pages = [{"text": line, "md": f"# {line}"} for line in lines]
+        return pages, len(lines), "\n".join(lines)
+
+
+@pytest.fixture
+def parser():
+    return StubParser()
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_miss_then_hit(tmp_path, parser):
+    cache = ParseCache(str(tmp_path / "cache"))
+    path = write(tmp_path, "a.pdf", "page one\npage two")
+
+    first = cache.get_or_parse(path, SETTINGS, parser)
+    second = cache.get_or_parse(path, SETTINGS, parser)
+
+    assert first == second
+    assert first[0] == [{"text": "page one", "md": "# page one"}, {"text": "page two", "md": "# page two"}]
+    assert parser.calls == [path]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_same_content_under_another_name_hits(tmp_path, parser):
+    cache = ParseCache(str(tmp_path / "cache"))
+    cache.get_or_parse(write(tmp_path, "a.pdf", "same bytes"), SETTINGS, parser)
+    cache.get_or_parse(write(tmp_path, "copy of a.pdf", "same bytes"), SETTINGS, parser)
+
+    assert len(parser.calls) == 1
+
+
+def test_changed_settings_or_content_use_a_new_key(tmp_path, parser):
+    cache = ParseCache(str(tmp_path / "cache"))
+    path = write(tmp_path, "a.pdf", "page one")
+    key = ParseCache.make_key(path, SETTINGS)
+
+    assert ParseCache.make_key(path, dict(reversed(list(SETTINGS.items())))) == key
+    assert ParseCache.make_key(path, {**SETTINGS, "language": "vi"}) != key
+
+    cache.get_or_parse(path, SETTINGS, parser)
+    cache.get_or_parse(path, {**SETTINGS, "language": "vi"}, parser)
+    write(tmp_path, "a.pdf", "page one, edited")
+    cache.get_or_parse(path, SETTINGS, parser)
+
+    assert len(parser.calls) == 3
+    assert cache.stats()["entries"] == 3
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, parser):
+    paths = [write(tmp_path, f"{i}.pdf", f"file {i} " + "x" * 200) for i in range(3)]
+    probe = ParseCache(str(tmp_path / "probe"))
+    probe.get_or_parse(paths[0], SETTINGS, parser)
+    entry_bytes = probe.stats()["bytes"]
+
+    # Room for two entries
+    cache = ParseCache(str(tmp_path / "cache"), max_bytes=2 * entry_bytes + entry_bytes // 2)
+    cache.get_or_parse(paths[0], SETTINGS, parser)
+    cache.get_or_parse(paths[1], SETTINGS, parser)
+    # Using the first entry makes the second one the oldest
+    cache.get_or_parse(paths[0], SETTINGS, parser)
+    cache.get_or_parse(paths[2], SETTINGS, parser)
+
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["entries"] == 2
+    assert stats["bytes"] <= cache.max_bytes
+    assert cache.get(ParseCache.make_key(paths[1], SETTINGS)) is None
+    assert cache.get(ParseCache.make_key(paths[0], SETTINGS)) is not None
+    assert cache.get(ParseCache.make_key(paths[2], SETTINGS)) is not None
+
+
+def test_entries_survive_a_restart(tmp_path, parser):
+    directory = str(tmp_path / "cache")
+    path = write(tmp_path, "a.pdf", "page one")
+    ParseCache(directory).get_or_parse(path, SETTINGS, parser)
+
+    reopened = ParseCache(directory)
+    assert reopened.stats()["entries"] == 1
+    reopened.get_or_parse(path, SETTINGS, parser)
+    assert len(parser.calls) == 1
+
+
+def test_corrupt_entry_is_a_miss(tmp_path, parser):
+    cache = ParseCache(str(tmp_path / "cache"))
+    path = write(tmp_path, "a.pdf", "page one")
+    cache.get_or_parse(path, SETTINGS, parser)
+    entry = os.path.join(cache.directory, f"{ParseCache.make_key(path, SETTINGS)}.json")
+    with open(entry, "w", encoding="utf-8") as f:
+        f.write("{not json")
+
+    pages, _, _ = cache.get_or_parse(path, SETTINGS, parser)
+
+    assert len(parser.calls) == 2
+    assert pages == [{"text": "page one", "md": "# page one"}]
+    with open(entry, "r", encoding="utf-8") as f:
+        assert json.load(f)["pages"] == pages
+
+
+def test_entry_evicted_after_read_is_still_a_hit(tmp_path, parser, monkeypatch):
+    cache = ParseCache(str(tmp_path / "cache"))
+    path = write(tmp_path, "a.pdf", "page one")
+    cache.get_or_parse(path, SETTINGS, parser)
+
+    def evicted(entry_path, times):
+        raise FileNotFoundError(entry_path)
+
+    monkeypatch.setattr(parse_cache.os, "utime", evicted)
+    pages, tokens, _ = cache.get_or_parse(path, SETTINGS, parser)
+
+    assert len(parser.calls) == 1
+    assert tokens == 1 and pages[0]["text"] == "page one"